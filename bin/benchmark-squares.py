@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Times finding colored squares in frames (videocapture.square.get_squares,
+# used for checkerboarding and capture signals) on synthetic frames: random
+# noise with a few squares of the color being looked for, speckled with
+# pixels close to that color and with gaps in the squares. Run it against
+# different versions of square.py to compare them.
+
+import numpy
+import optparse
+import time
+from videocapture import square
+
+COLOR = (255, 0, 255)
+
+
+def get_frame(random, width, height, num_squares):
+    frame = random.randint(0, 256, (height, width, 3)).astype(numpy.int16)
+    for i in range(num_squares):
+        y = random.randint(0, height - 50)
+        x = random.randint(0, width - 50)
+        frame[y:y + random.randint(1, 300), x:x + random.randint(1, 400)] = \
+            COLOR
+    frame[random.rand(height, width) < 0.02] = (250, 3, 250)
+    frame[random.rand(height, width) < 0.01] = (0, 0, 0)
+    return frame
+
+
+usage = "usage: %prog [options]"
+parser = optparse.OptionParser(usage)
+parser.add_option("--sizes", action="store", dest="sizes",
+                  default="1280x720,1920x1080",
+                  help="comma separated frame sizes to time "
+                  "(default: %default)")
+parser.add_option("--squares", action="store", type="int", dest="squares",
+                  default=6,
+                  help="number of squares in each frame (default: %default)")
+parser.add_option("--runs", action="store", type="int", dest="runs",
+                  default=5,
+                  help="number of times to time each case, the average of "
+                  "which is reported (default: %default)")
+options, args = parser.parse_args()
+if args:
+    parser.error("incorrect number of arguments")
+try:
+    sizes = [tuple(int(dimension) for dimension in size.split('x'))
+             for size in options.sizes.split(',')]
+except ValueError:
+    parser.error("sizes must be given as <width>x<height>")
+
+# the same frames every time, so runs can be compared
+random = numpy.random.RandomState(0)
+
+row_format = "%12s %18s %20s"
+print row_format % ("size", "single scanline", "multiple scanlines")
+for (width, height) in sizes:
+    frame = get_frame(random, width, height, options.squares)
+    times = []
+    for handle_multiple_scanlines in (False, True):
+        start = time.time()
+        for i in range(options.runs):
+            square.get_squares(COLOR, frame, handle_multiple_scanlines=
+                               handle_multiple_scanlines)
+        times.append((time.time() - start) / options.runs)
+    print row_format % ("%sx%s" % (width, height),
+                        "%.1fms" % (times[0] * 1000),
+                        "%.1fms" % (times[1] * 1000))
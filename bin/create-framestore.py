@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import optparse
+import videocapture
+
+usage = "usage: %prog [options] <capture file> [capture file...]"
+parser = optparse.OptionParser(usage)
+options, args = parser.parse_args()
+if not args:
+    parser.error("incorrect number of arguments")
+
+for capture_filename in args:
+    print "Creating frame store for %s..." % capture_filename
+    print "Wrote %s" % videocapture.create_framestore(capture_filename)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Compares the metrics worked out from downsampled frames against those
+# worked out at full resolution, to see how far a set of captures can be
+# downsampled (see videocapture.get_frame_analyses) before the results
+# stop being useful.
+
+import optparse
+import os
+import shutil
+import tempfile
+import time
+import videocapture
+from videocapture.cache import AnalysisCache
+
+
+def get_metrics(filename, cachedir, downsample):
+    # a fresh capture (and cache) for each run, so nothing decoded or worked
+    # out for one factor gets reused for another
+    capture = videocapture.Capture(filename)
+    capture.cache = AnalysisCache(os.path.join(
+        cachedir, '%s-%s.sqlite' % (os.path.basename(filename), downsample)))
+
+    start = time.time()
+    videocapture.get_frame_analyses(
+        capture, [videocapture.FrameDifferenceHistogramAnalyzer(),
+                  videocapture.EntropyAnalyzer(),
+                  videocapture.CheckerboardAnalyzer()],
+        downsample=downsample)
+    elapsed = time.time() - start
+
+    # the rest just come out of the cache
+    return {'time': elapsed,
+            'uniqueFrames': videocapture.get_num_unique_frames(
+                capture, downsample=downsample),
+            'stableFrame': videocapture.get_stable_frame(
+                capture, downsample=downsample),
+            'overallEntropy': sum(videocapture.get_frame_entropies(
+                capture, downsample=downsample)),
+            'checkerboard': videocapture.get_checkerboarding_area_duration(
+                capture, downsample=downsample)}
+
+
+usage = "usage: %prog [options] <capture file> [capture file...]"
+parser = optparse.OptionParser(usage)
+parser.add_option("--factors", action="store", dest="factors",
+                  default="2,4,8",
+                  help="comma separated factors to downsample frames by "
+                  "(default: %default)")
+options, args = parser.parse_args()
+if not args:
+    parser.error("incorrect number of arguments")
+try:
+    factors = [int(factor) for factor in options.factors.split(',')]
+except ValueError:
+    parser.error("factors must be whole numbers")
+if any(factor < 2 for factor in factors):
+    parser.error("factors must be at least 2")
+
+row_format = "%8s %9s %14s %13s %16s %13s"
+print row_format % ("factor", "time (s)", "unique frames", "stable frame",
+                    "overall entropy", "checkerboard")
+
+# largest difference from full resolution seen for each factor
+worst = dict((factor, {'stableFrame': 0, 'uniqueFrames': 0,
+                       'overallEntropy': 0.0, 'checkerboard': 0.0,
+                       'speedup': None})
+             for factor in factors)
+
+cachedir = tempfile.mkdtemp()
+try:
+    for filename in args:
+        capture = videocapture.Capture(filename)
+        print
+        print "%s (%sx%s, %s frames)" % ((filename,) + capture.dimensions +
+                                         (capture.num_frames + 1,))
+
+        full = get_metrics(filename, cachedir, 1)
+        print row_format % (1, "%.2f" % full['time'], full['uniqueFrames'],
+                            full['stableFrame'],
+                            "%.2f" % full['overallEntropy'],
+                            "%.4f" % full['checkerboard'])
+        for factor in factors:
+            metrics = get_metrics(filename, cachedir, factor)
+            print row_format % (factor, "%.2f" % metrics['time'],
+                                "%+d" % (metrics['uniqueFrames'] -
+                                         full['uniqueFrames']),
+                                "%+d" % (metrics['stableFrame'] -
+                                         full['stableFrame']),
+                                "%+.2f%%" % (100.0 * (
+                                    metrics['overallEntropy'] /
+                                    full['overallEntropy'] - 1)
+                                    if full['overallEntropy'] else 0.0),
+                                "%+.4f" % (metrics['checkerboard'] -
+                                           full['checkerboard']))
+
+            stats = worst[factor]
+            for key in ('stableFrame', 'uniqueFrames', 'checkerboard'):
+                stats[key] = max(stats[key],
+                                 abs(metrics[key] - full[key]))
+            if full['overallEntropy']:
+                stats['overallEntropy'] = max(
+                    stats['overallEntropy'],
+                    abs(metrics['overallEntropy'] / full['overallEntropy'] -
+                        1))
+            speedup = full['time'] / max(metrics['time'], 0.001)
+            if stats['speedup'] is None or speedup < stats['speedup']:
+                stats['speedup'] = speedup
+finally:
+    shutil.rmtree(cachedir)
+
+print
+print "Worst differences from full resolution over all captures:"
+for factor in factors:
+    stats = worst[factor]
+    print "  %sx: stable frame %s, unique frames %s, overall entropy " \
+        "%.2f%%, checkerboard %.4f (at least %.1fx faster)" % (
+            factor, stats['stableFrame'], stats['uniqueFrames'],
+            100.0 * stats['overallEntropy'], stats['checkerboard'],
+            stats['speedup'])
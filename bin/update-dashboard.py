@@ -23,7 +23,7 @@ def get_revision_data(sources_xml):
     return revision_data
 
 def runtest(dm, device_prefs, options, product, appinfo, testinfo,
-            capture_name):
+            capture_name, video_encode_queue):
     capture_filename = os.path.join(CAPTURE_DIR,
                                     "%s-%s-%s-%s.zip" % (testinfo['key'],
                                                          options.appname,
@@ -69,9 +69,12 @@ def runtest(dm, device_prefs, options, product, appinfo, testinfo,
         # video file
         video_relpath = os.path.join('videos', 'video-%s.webm' % time.time())
         video_path = os.path.join(options.dashboard_dir, video_relpath)
-        open(video_path, 'w').write(capture.get_video().read())
+        # if the capture was written without a movie, this encodes one in
+        # the background while we carry on with other runs
+        video_job = video_encode_queue.put(capture_filename, video_path)
     else:
         video_relpath = None
+        video_job = None
 
     # app/product date
     appdate = appinfo['appdate']
@@ -116,13 +119,26 @@ def runtest(dm, device_prefs, options, product, appinfo, testinfo,
             log_http_requests=(testtype == 'webstartup'),
             log_actions=(testtype == 'web' or testtype == 'b2g')))
 
-    # Write testdata
+    # the test data gets written out once the video is in place (see
+    # write_testdata)
+    return (video_job, productname, appdate, datapoint, metadata)
+
+def write_testdata(options, testinfo, video_job, productname, appdate,
+                   datapoint, metadata):
+    succeeded = True
+    if video_job and video_job.error:
+        # don't link to a video which was never written
+        print "%s. Keeping the results without a video." % video_job.error
+        metadata['video'] = None
+        succeeded = False
+
     eideticker.update_dashboard_testdata(options.dashboard_dir,
                                          options.dashboard_id,
                                          options.device_id,
                                          options.branch_id, testinfo,
                                          productname, appdate,
                                          datapoint, metadata)
+    return succeeded
 
 def main(args=sys.argv[1:]):
     usage = "usage: %prog [options] TEST..."
@@ -245,6 +261,8 @@ def main(args=sys.argv[1:]):
     else:
         print "Unknown device type '%s'!" % options.devicetype
 
+    video_encode_queue = videocapture.VideoEncodeQueue(options.use_vpxenc)
+
     # run through the tests...
     failed_tests = []
     for testkey in args:
@@ -262,16 +280,26 @@ def main(args=sys.argv[1:]):
             eideticker.prepare_test(testkey, options)
 
         # Run the test the specified number of times
+        runs = []
         for i in range(options.num_runs):
             try:
-                runtest(device, device_prefs, options,
-                        product, appinfo, testinfo,
-                        options.capture_name + " #%s" % i)
+                runs.append(runtest(device, device_prefs, options,
+                                    product, appinfo, testinfo,
+                                    options.capture_name + " #%s" % i,
+                                    video_encode_queue))
             except eideticker.TestException:
                 print "Unable to run test '%s'. Skipping and continuing." % testkey
                 failed_tests.append(testkey)
                 break
 
+        # all the videos need to be in place before we write out the test
+        # data and synchronize
+        video_encode_queue.join()
+        for run in runs:
+            if not write_testdata(options, testinfo, *run) and \
+                    testkey not in failed_tests:
+                failed_tests.append(testkey)
+
         # synchronize with dashboard (if we have a server to upload to)
         if options.dashboard_server:
             eideticker.upload_dashboard(options)
@@ -34,8 +34,38 @@ def _get_analysis_props(capture_device):
                         "to calculate metrics" % capture_device)
 
 
+def _analyze_capture(capture, standard_metrics=False):
+    """ Run all the per-frame analyses the standard metrics and metric
+        metadata for a capture depend on in one pass over the capture, so
+        each frame only gets decoded once. The results get cached, so the
+        individual videocapture functions used below just look them up. """
+    analysis_props = _get_analysis_props(capture.metadata['captureDevice'])
+
+    # frame difference sums (for any threshold) get worked out from these
+    analyzers = [videocapture.FrameDifferenceHistogramAnalyzer()]
+    # entropy based stable frame detection uses plain entropies
+    edge_detections = set(['canny', analysis_props['edge_detection']])
+    if analysis_props['stable_frame_analysis_method'] == 'entropy':
+        edge_detections.add(None)
+    for edge_detection in edge_detections:
+        analyzers.append(videocapture.EntropyAnalyzer(
+            edge_detection=edge_detection))
+    if standard_metrics and \
+            'checkerboard' in analysis_props['valid_measures']:
+        analyzers.append(videocapture.CheckerboardAnalyzer())
+    # the per-region series get_standard_metric_metadata asks
+    # videocapture.get_region_analyses for: checkerboarding isn't one of
+    # them, any more than it is for the whole capture
+    for region in videocapture.get_regions(capture):
+        analyzers.extend([
+            videocapture.FrameDifferenceHistogramAnalyzer(region=region),
+            videocapture.EntropyAnalyzer(region=region)])
+
+    videocapture.get_frame_analyses(capture, analyzers)
+
 def get_stable_frame_time(capture):
     analysis_props = _get_analysis_props(capture.metadata['captureDevice'])
+    _analyze_capture(capture)
     return videocapture.get_stable_frame_time(
         capture, method=analysis_props['stable_frame_analysis_method'],
         threshold=analysis_props['stable_frame_threshold'],
@@ -43,6 +73,7 @@ def get_stable_frame_time(capture):
 
 def get_standard_metrics(capture, actions):
     analysis_props = _get_analysis_props(capture.metadata['captureDevice'])
+    _analyze_capture(capture, standard_metrics=True)
 
     metrics = {}
     if 'unique_frames' in analysis_props['valid_measures']:
@@ -79,6 +110,12 @@ def get_standard_metrics(capture, actions):
     return metrics
 
 def get_standard_metric_metadata(capture):
-    return { 'framediffsums': videocapture.get_framediff_sums(capture),
-             'framecannyentropies': videocapture.get_frame_entropies(
-            capture, edge_detection='canny') }
+    _analyze_capture(capture)
+    metadata = {'framediffsums': videocapture.get_framediff_sums(capture),
+                'framecannyentropies': videocapture.get_frame_entropies(
+                    capture, edge_detection='canny')}
+    if videocapture.get_regions(capture):
+        metadata['regions'] = videocapture.get_region_analyses(
+            capture, checkerboard=False)
+
+    return metadata
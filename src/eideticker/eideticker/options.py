@@ -93,6 +93,16 @@ class TestOptionParser(CaptureOptionParser):
                         help="Skip video capture (mainly for debugging)")
         self.add_option("--vpxenc", action="store_true",
                         dest="use_vpxenc", help="Use vpxenc for encoding video")
+        self.add_option("--defer-webm", action="store_true",
+                        dest="defer_webm", default=False,
+                        help="Don't encode a video while converting the "
+                        "capture, only once it is first needed")
+        self.add_option("--stop-when-stable", action="store", type="float",
+                        dest="stable_capture_period", default=None,
+                        metavar="SECONDS",
+                        help="End the capture once the screen has been "
+                        "stable for this many seconds, rather than waiting "
+                        "for the test's capture timeout (decklink only)")
         self.add_option("--gecko-profiler-addon-dir", action="store",
                         dest="gecko_profiler_addon_dir", default=GECKO_PROFILER_ADDON_DIR,
                         help="Path to gecko profiler addon (default: %default)")
@@ -171,17 +171,26 @@ class Test(object):
             timeout = 100
         timer = 0
         interval = 0.1
+        stable = False
 
         try:
             while not self.finished_capture and timer < timeout:
+                if self.capture_controller and \
+                        self.capture_controller.capture_stable():
+                    # nothing more is going to happen, no need to wait for
+                    # the timeout
+                    self.logger.info("Capture stable, ending it early")
+                    stable = True
+                    break
                 time.sleep(interval)
                 timer += interval
         except KeyboardInterrupt:
             self.end_capture()
             raise
 
-        if self.capture_timeout and not self.finished_capture:
-            # this test was meant to time out, ok
+        if (self.capture_timeout or stable) and not self.finished_capture:
+            # this test was meant to time out (or settled down before it
+            # did), ok
             self.test_finished()
             self.end_capture()
         elif not self.finished_capture:
@@ -1,5 +1,7 @@
+import collections
 import templeton
 import os
+import threading
 import web
 import videocapture
 
@@ -8,6 +10,36 @@ from PIL import Image
 CAPTURE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                            "../../../../../captures"))
 
+# captures written without a movie get one encoded when it's first asked
+# for, one at a time
+video_encode_queue = videocapture.VideoEncodeQueue()
+
+# captures are kept open between requests, so that frames decoded for one
+# can be reused by the next (e.g. stepping through the frame difference
+# images, which each need the frame before too). Each one holds on to up
+# to videocapture's DEFAULT_FRAME_CACHE_SIZE of frames, so only keep the
+# few looked at most recently.
+MAX_OPEN_CAPTURES = 4
+open_captures = collections.OrderedDict()
+open_captures_lock = threading.Lock()
+
+
+def get_capture(name):
+    '''The capture called name, only opened again if it has changed since
+       it was last asked for'''
+    fname = os.path.join(CAPTURE_DIR, name)
+    with open_captures_lock:
+        (capture, mtime) = open_captures.pop(fname, (None, None))
+        if capture is None or not os.path.exists(fname) or \
+                os.path.getmtime(fname) != mtime:
+            capture = videocapture.Capture(fname)
+            mtime = os.path.getmtime(fname)
+        open_captures[fname] = (capture, mtime)
+        while len(open_captures) > MAX_OPEN_CAPTURES:
+            open_captures.popitem(last=False)
+
+    return capture
+
 
 class CapturesHandler:
 
@@ -42,7 +74,7 @@ class CaptureHandler:
     def GET(self, name):
         try:
             fname = os.path.join(CAPTURE_DIR, name)
-            capture = videocapture.Capture(fname)
+            capture = get_capture(name)
 
             return dict({"id": name, "length": capture.num_frames / 60.0,
                          "numFrames": capture.num_frames, "filename": fname},
@@ -55,8 +87,8 @@ class CaptureVideoHandler:
 
     def GET(self, name):
         try:
-            capture = videocapture.Capture(os.path.join(CAPTURE_DIR, name))
-            videofile = capture.get_video()
+            videofile = video_encode_queue.get_video(
+                os.path.join(CAPTURE_DIR, name))
             data = videofile.getvalue()
             web.header('Content-Type', 'video/webm')
 
@@ -96,7 +128,7 @@ class CaptureImageHandler:
     def GET(self, name, num):
         params, body = templeton.handlers.get_request_parms()
         (width, height) = (params.get('width'), params.get('height'))
-        capture = videocapture.Capture(os.path.join(CAPTURE_DIR, name))
+        capture = get_capture(name)
         im = capture.get_frame_image(int(num))
         if width and height:
             im.thumbnail((int(width[0]), int(height[0])), Image.ANTIALIAS)
@@ -108,7 +140,7 @@ class FrameDifferenceHandler:
 
     @templeton.handlers.json_response
     def GET(self, name):
-        capture = videocapture.Capture(os.path.join(CAPTURE_DIR, name))
+        capture = get_capture(name)
         return videocapture.get_framediff_sums(capture)
 
 
@@ -119,7 +151,7 @@ class FrameDifferenceImageHandler:
         params, body = templeton.handlers.get_request_parms()
         (width, height) = (params.get('width'), params.get('height'))
 
-        capture = videocapture.Capture(os.path.join(CAPTURE_DIR, name))
+        capture = get_capture(name)
         im = videocapture.get_framediff_image(capture, framenum1, framenum2)
         if width and height:
             im.thumbnail((int(width[0]), int(height[0])), Image.ANTIALIAS)
@@ -131,7 +163,7 @@ class CheckerboardHandler:
 
     @templeton.handlers.json_response
     def GET(self, name):
-        capture = videocapture.Capture(os.path.join(CAPTURE_DIR, name))
+        capture = get_capture(name)
         percents = videocapture.get_checkerboarding_percents(capture)
         area_duration = videocapture.get_checkerboarding_area_duration(capture)
         return {"areaDuration": area_duration,
@@ -146,7 +178,7 @@ class CheckerboardImageHandler:
         params, body = templeton.handlers.get_request_parms()
         (width, height) = (params.get('width'), params.get('height'))
 
-        capture = videocapture.Capture(os.path.join(CAPTURE_DIR, name))
+        capture = get_capture(name)
         im = videocapture.get_checkerboard_image(capture, framenum)
         if width and height:
             im.thumbnail((int(width[0]), int(height[0])), Image.ANTIALIAS)
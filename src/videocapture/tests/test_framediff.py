@@ -0,0 +1,122 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Checks get_framediff_imgarray against the per-pixel loop it replaced. Run
+# with: python -m unittest discover -s src/videocapture/tests
+
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from videocapture.framediff import get_framediff_imgarray, \
+    PIXEL_DIFF_THRESHOLD
+
+
+class SyntheticCapture(object):
+    '''Just enough of a capture for get_framediff_imgarray, with frames
+       given as arrays'''
+
+    def __init__(self, frames, ignore_areas=None):
+        self.frames = frames
+        self.metadata = {}
+        if ignore_areas is not None:
+            self.metadata['ignoreAreas'] = ignore_areas
+
+    def get_frame(self, framenum, cropped=False, grayscale=False):
+        return self.frames[framenum]
+
+
+def reference_imgarray(capture, framenum1, framenum2,
+                       filter_low_differences=True):
+    '''The original, per-pixel, get_framediff_imgarray'''
+    filter_threshold = 0
+    if filter_low_differences:
+        filter_threshold = PIXEL_DIFF_THRESHOLD
+
+    ignored_areas = capture.metadata.get('ignoreAreas') or []
+
+    frame1 = capture.get_frame(framenum1)
+    frame2 = capture.get_frame(framenum2)
+    framediff = numpy.abs(frame1.astype('float') - frame2.astype('float'))
+    for (y, row) in enumerate(framediff):
+        for (x, px) in enumerate(row):
+            skip = False
+            for ignored_area in ignored_areas:
+                if y >= ignored_area[1] and y < ignored_area[3] and \
+                        x >= ignored_area[0] and x < ignored_area[2]:
+                    skip = True
+                    break
+
+            if not skip and (px[0] >= filter_threshold or
+                             px[1] >= filter_threshold or
+                             px[2] >= filter_threshold):
+                px[0] = 255.0
+                px[1] = 0.0
+                px[2] = 0.0
+            else:
+                px[0] = px[1] = px[2] = 0.0
+
+    return framediff
+
+
+def get_synthetic_frames(width=40, height=30):
+    '''Pairs of frames with a mix of small and large differences, some of
+       them in only one color component'''
+    random = numpy.random.RandomState(0)
+    frame1 = random.randint(0, 256, (height, width, 3)).astype(numpy.uint8)
+    frame2 = frame1.astype(numpy.int16)
+    # differences right around the threshold, in one component at a time
+    for offset in (-PIXEL_DIFF_THRESHOLD - 1, -PIXEL_DIFF_THRESHOLD,
+                   -PIXEL_DIFF_THRESHOLD + 1, PIXEL_DIFF_THRESHOLD - 1,
+                   PIXEL_DIFF_THRESHOLD, PIXEL_DIFF_THRESHOLD + 1):
+        ys = random.randint(0, height, 20)
+        xs = random.randint(0, width, 20)
+        components = random.randint(0, 3, 20)
+        frame2[ys, xs, components] += int(offset)
+    # and a block which changes completely
+    frame2[5:15, 10:25] = 255 - frame2[5:15, 10:25]
+    frame2 = numpy.clip(frame2, 0, 255).astype(numpy.uint8)
+
+    return [frame1, frame2, frame1.copy()]
+
+
+class TestFramediffImgarray(unittest.TestCase):
+
+    def assertSameAsReference(self, capture):
+        for (framenum1, framenum2) in ((0, 1), (1, 0), (0, 2)):
+            for filter_low_differences in (True, False):
+                expected = reference_imgarray(capture, framenum1, framenum2,
+                                              filter_low_differences)
+                actual = get_framediff_imgarray(
+                    capture, framenum1, framenum2,
+                    filter_low_differences=filter_low_differences)
+                self.assertEqual(actual.dtype, expected.dtype)
+                self.assertTrue(numpy.array_equal(actual, expected))
+
+    def test_no_ignore_areas(self):
+        self.assertSameAsReference(SyntheticCapture(get_synthetic_frames()))
+
+    def test_ignore_areas(self):
+        self.assertSameAsReference(SyntheticCapture(
+            get_synthetic_frames(), [[0, 0, 40, 3], [12, 8, 20, 12]]))
+
+    def test_unusual_ignore_areas(self):
+        # empty, partly off the top left of the frame and past the bottom
+        # right of it
+        self.assertSameAsReference(SyntheticCapture(
+            get_synthetic_frames(),
+            [[10, 10, 10, 20], [20, 5, 15, 8], [-5, -5, 8, 6],
+             [30, 20, 60, 50]]))
+
+    def test_identical_frames(self):
+        capture = SyntheticCapture(get_synthetic_frames())
+        self.assertFalse(get_framediff_imgarray(capture, 0, 2).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
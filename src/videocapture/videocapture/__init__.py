@@ -3,9 +3,12 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from controller import CaptureController
-from capture import Capture, BadCapture
+from capture import Capture, BadCapture, create_framestore
 from checkerboard import *
-from framediff import get_framediff_imgarray, get_framediff_image, get_framediff_sums, get_num_unique_frames, get_fps
-from entropy import get_overall_entropy, get_frame_entropies
-from stableframe import get_stable_frame, get_stable_frame_time
+from framediff import get_framediff_imgarray, get_framediff_image, get_framediff_sums, get_framediff_histograms, get_framediff_counts, get_num_unique_frames, get_fps
+from entropy import get_overall_entropy, get_frame_entropies, get_entropies
+from stableframe import get_stable_frame, get_stable_frame_time, get_stable_frame_pvalues
+from analysis import get_frame_analyses, get_region_analyses, FrameDifferenceAnalyzer, FrameDifferenceHistogramAnalyzer, EntropyAnalyzer, CheckerboardAnalyzer, SquareAnalyzer
 from options import OptionParser
+from regions import Region, get_regions
+from videoqueue import VideoEncodeQueue, VideoEncodeJob
@@ -0,0 +1,340 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Runs several per-frame analyses over a capture in a single pass, so that
+# each frame only needs to be decoded once no matter how many different
+# things we want to know about it.
+
+from capture import downsample_image, get_downsample_params
+from checkerboard import _get_checkerboard_percent, CHECKERBOARD_VERSION
+from entropy import _get_entropy, _get_entropy_params, ENTROPY_VERSION
+from framediff import _get_framediff_sum, _get_framediff_params, \
+    _get_framediff_histogram, _get_framediff_histogram_params, \
+    _downsample_areas, get_framediff_counts, FRAMEDIFF_VERSION, \
+    PIXEL_DIFF_THRESHOLD
+from frameresults import get_cached_frame_results
+from parallel import get_frame_runs, map_frame_range_list
+from regions import get_region, get_regions
+import numpy
+import square
+
+
+class DecodedFrame(object):
+    '''A frame which has been decoded once, and can be handed out as numpy
+       arrays in whatever form an analyzer wants'''
+
+    def __init__(self, capture, framenum, downsample=1):
+        self.framenum = framenum
+        self.downsample = downsample
+        self.image = capture.get_frame_image(framenum)
+        self._grayscale_image = None
+        self._arrays = {}
+
+    def get_array(self, grayscale=False, type=numpy.float):
+        key = (grayscale, numpy.dtype(type).str)
+        if key not in self._arrays:
+            im = self.image
+            if grayscale:
+                if not self._grayscale_image:
+                    self._grayscale_image = self.image.convert("L")
+                im = self._grayscale_image
+            if self.downsample != 1:
+                im = downsample_image(im, self.downsample)
+            self._arrays[key] = numpy.array(im, dtype=type)
+
+        return self._arrays[key]
+
+
+class Analyzer(object):
+    '''Base class for per-frame analyzers. name is the key the results are
+       returned under, first_frame the first frame of the capture the
+       analyzer produces a result for. Results are cached under cache_name,
+       params and version (see cache.AnalysisCache). downsample is the
+       factor the frames being analyzed have been shrunk by, and region the
+       region of the frames to analyze (see regions.Region), if there is one
+       (both set before setup is called).'''
+
+    name = None
+    cache_name = None
+    version = 1
+    first_frame = 0
+    needs_previous_frame = False
+    downsample = 1
+    region_name = None
+    region = None
+
+    def _set_region_name(self, region_name):
+        # results for a region are returned under a name of their own
+        self.region_name = region_name
+        if region_name:
+            self.name = '%s_%s' % (self.name, region_name)
+
+    def setup(self, capture):
+        '''Called once in the main process before any frames are analyzed'''
+        pass
+
+    def get_params(self):
+        return {}
+
+    def get_mask(self, array):
+        '''The pixels of a frame in the region being analyzed (or None if
+           the whole frame is)'''
+        if self.region is None:
+            return None
+        return self.region.get_mask(array.shape, self.downsample)
+
+    def analyze(self, frame, prevframe):
+        raise NotImplementedError
+
+
+class FrameDifferenceAnalyzer(Analyzer):
+    '''Number of pixels different from the previous frame (see
+       framediff.get_framediff_sums)'''
+
+    name = cache_name = 'diffsums'
+    version = FRAMEDIFF_VERSION
+    needs_previous_frame = True
+
+    def __init__(self, filter_low_differences=True, region=None):
+        self._set_region_name(region)
+        self.filter_threshold = 0
+        if filter_low_differences:
+            self.filter_threshold = PIXEL_DIFF_THRESHOLD
+        self.ignored_areas = []
+
+    def setup(self, capture):
+        self.ignored_areas = capture.metadata.get('ignoreAreas') or []
+        self.frame_ignored_areas = _downsample_areas(self.ignored_areas,
+                                                     self.downsample)
+
+    def get_params(self):
+        return _get_framediff_params(self.ignored_areas, self.filter_threshold)
+
+    def analyze(self, frame, prevframe):
+        if prevframe is None or prevframe is frame:
+            return 0
+        array = frame.get_array(True)
+        return _get_framediff_sum(prevframe.get_array(True), array,
+                                  self.frame_ignored_areas,
+                                  self.filter_threshold,
+                                  self.get_mask(array))
+
+
+class FrameDifferenceHistogramAnalyzer(Analyzer):
+    '''Histogram of how much each pixel differs from the previous frame (see
+       framediff.get_framediff_histograms), from which frame difference
+       sums for any threshold can be worked out'''
+
+    name = cache_name = 'diffhistograms'
+    version = FRAMEDIFF_VERSION
+    needs_previous_frame = True
+
+    def __init__(self, region=None):
+        self._set_region_name(region)
+
+    def setup(self, capture):
+        self.ignored_areas = capture.metadata.get('ignoreAreas') or []
+        self.frame_ignored_areas = _downsample_areas(self.ignored_areas,
+                                                     self.downsample)
+
+    def get_params(self):
+        return _get_framediff_histogram_params(self.ignored_areas)
+
+    def analyze(self, frame, prevframe):
+        if prevframe is None:
+            return numpy.zeros(256, dtype=numpy.uint32)
+        array = frame.get_array(True)
+        mask = self.get_mask(array)
+        if prevframe is frame:
+            histogram = numpy.zeros(256, dtype=numpy.uint32)
+            histogram[0] = array.size if mask is None else \
+                numpy.count_nonzero(mask)
+            return histogram
+        return _get_framediff_histogram(prevframe.get_array(True), array,
+                                        self.frame_ignored_areas, mask)
+
+
+class EntropyAnalyzer(Analyzer):
+    '''Entropy of each frame (see entropy.get_frame_entropies)'''
+
+    cache_name = 'frame_entropies'
+    version = ENTROPY_VERSION
+
+    def __init__(self, edge_detection=None, region=None):
+        self.edge_detection = edge_detection
+        self.name = 'frame_entropies'
+        if edge_detection:
+            self.name += '_%s' % edge_detection
+        self._set_region_name(region)
+
+    def get_params(self):
+        return _get_entropy_params(self.edge_detection)
+
+    def analyze(self, frame, prevframe):
+        array = frame.get_array(True, numpy.uint8)
+        return _get_entropy(array, self.edge_detection, self.get_mask(array))
+
+
+class CheckerboardAnalyzer(Analyzer):
+    '''Percentage of each frame which is checkerboarding (see
+       checkerboard.get_checkerboarding_percents)'''
+
+    name = cache_name = 'checkerboard_percents'
+    version = CHECKERBOARD_VERSION
+    first_frame = 1
+
+    def __init__(self, region=None):
+        self._set_region_name(region)
+
+    def analyze(self, frame, prevframe):
+        array = frame.get_array(type=numpy.int16)
+        return _get_checkerboard_percent(array,
+                                         (array.shape[1], array.shape[0]),
+                                         self.get_mask(array))
+
+
+class SquareAnalyzer(Analyzer):
+    '''The biggest square of a given color in each frame (or None)'''
+
+    cache_name = 'squares'
+
+    def __init__(self, rgb, name=None):
+        self.rgb = tuple(rgb)
+        self.name = name or 'squares_%s_%s_%s' % self.rgb
+
+    def get_params(self):
+        return {'rgb': list(self.rgb)}
+
+    def analyze(self, frame, prevframe):
+        return square.get_biggest_square(self.rgb,
+                                         frame.get_array(type=numpy.int16))
+
+
+def _analyze_frames((capture, start, end, analyzers, downsample)):
+    needs_previous_frame = any(analyzer.needs_previous_frame for analyzer
+                               in analyzers)
+    prevframe = None
+    if needs_previous_frame and start > 0:
+        prevframe = DecodedFrame(capture, start - 1, downsample)
+
+    results = []
+    for i in range(start, end):
+        if prevframe is not None and capture.frames_identical(i - 1, i):
+            # same image as the last frame: no need to decode it again, or
+            # to work out anything which doesn't depend on the frame before
+            frame = prevframe
+            frameresults = []
+            for (j, analyzer) in enumerate(analyzers):
+                if results and i - 1 >= analyzer.first_frame and \
+                        not analyzer.needs_previous_frame:
+                    frameresults.append(results[-1][j])
+                elif i >= analyzer.first_frame:
+                    frameresults.append(analyzer.analyze(frame, prevframe))
+                else:
+                    frameresults.append(None)
+            results.append(tuple(frameresults))
+            continue
+
+        frame = DecodedFrame(capture, i, downsample)
+        results.append(tuple(analyzer.analyze(frame, prevframe)
+                             if i >= analyzer.first_frame else None
+                             for analyzer in analyzers))
+        prevframe = frame
+
+    return results
+
+
+def _get_analyzer_params(analyzer):
+    params = get_downsample_params(analyzer.get_params(), analyzer.downsample)
+    if analyzer.region is not None:
+        # results get worked out again if the region is redefined
+        params = dict(params or {})
+        params['region'] = analyzer.region.get_params()
+    return params
+
+
+def get_frame_analyses(capture, analyzers, max_workers=None, downsample=1):
+    '''Run a set of analyzers over every frame in a capture, decoding each
+       frame only once. Returns a dictionary mapping each analyzer's name to
+       its per-frame results. Results are read from (and stored in) the
+       capture's cache for each frame (see frameresults), so only frames
+       which some analyzer has no results for get analyzed.
+
+       If downsample is given, the analyzers are run on frames shrunk by
+       that factor (see Capture.get_frame), which is a lot quicker for
+       large frames at the cost of some accuracy.'''
+    analyses = {}
+    pending = []
+    for analyzer in analyzers:
+        analyzer.downsample = downsample
+        if analyzer.region_name:
+            analyzer.region = get_region(capture, analyzer.region_name)
+        analyzer.setup(capture)
+        (framekeys, results, missing) = get_cached_frame_results(
+            capture, analyzer.cache_name, analyzer.first_frame,
+            _get_analyzer_params(analyzer), analyzer.version,
+            analyzer.needs_previous_frame)
+        analyses[analyzer.name] = results
+        if missing:
+            pending.append((analyzer, framekeys, set(missing)))
+
+    if pending:
+        (pending_analyzers, _, pending_missing) = zip(*pending)
+        ranges = get_frame_runs(sorted(set.union(*pending_missing)))
+        range_results = map_frame_range_list(
+            _analyze_frames, capture, ranges,
+            args=(list(pending_analyzers), downsample),
+            max_workers=max_workers)
+        for (i, (analyzer, framekeys, missing)) in enumerate(pending):
+            results = analyses[analyzer.name]
+            new_results = {}
+            for ((start, end), results_in_range) in zip(ranges,
+                                                        range_results):
+                for (framenum, frameresults) in zip(range(start, end),
+                                                    results_in_range):
+                    if framenum in missing:
+                        j = framenum - analyzer.first_frame
+                        results[j] = new_results[framekeys[j]] = \
+                            frameresults[i]
+            capture.cache.set_frames(analyzer.cache_name, new_results,
+                                     _get_analyzer_params(analyzer),
+                                     analyzer.version)
+
+    return analyses
+
+
+def get_region_analyses(capture, regions=None, max_workers=None,
+                        downsample=1, checkerboard=True):
+    '''Frame difference sums, entropies and (unless checkerboard is false)
+       checkerboard percentages for each region of a capture (see
+       regions.get_regions), or just the ones named in regions, worked out
+       in a single pass over the capture. Returns a dictionary mapping each
+       region's name to a dictionary of its per-frame results.'''
+    if regions is None:
+        regions = sorted(get_regions(capture).keys())
+
+    analyzers = {}
+    for region in regions:
+        analyzers[region] = [FrameDifferenceHistogramAnalyzer(region=region),
+                             EntropyAnalyzer(region=region)]
+        if checkerboard:
+            analyzers[region].append(CheckerboardAnalyzer(region=region))
+    analyses = get_frame_analyses(capture, [analyzer for region in regions
+                                            for analyzer in
+                                            analyzers[region]],
+                                  max_workers=max_workers,
+                                  downsample=downsample)
+
+    results = {}
+    for region in regions:
+        (histograms, entropies) = analyzers[region][:2]
+        results[region] = {
+            'diffsums': get_framediff_counts(analyses[histograms.name],
+                                             PIXEL_DIFF_THRESHOLD),
+            'frame_entropies': analyses[entropies.name]}
+        if checkerboard:
+            results[region]['checkerboard_percents'] = \
+                analyses[analyzers[region][2].name]
+
+    return results
@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import cPickle as pickle
+import json
+import os
+import sqlite3
+
+# how long (in seconds) to wait for another process to finish writing to a
+# cache before giving up
+CACHE_TIMEOUT = 60
+
+
+class AnalysisCache(object):
+    '''A store for hard-to-generate data about a capture's frames (frame
+       difference sums, entropies, ...), kept in an SQLite database
+       alongside it.
+
+       Each frame's result is stored on its own, keyed by the frame's
+       contents rather than its number (see Capture.get_frame_key), so it
+       stays valid when frames are added to or removed from a capture. It
+       is also keyed by the name of the analysis, the parameters it was run
+       with and the version of the code that generated it, so changing
+       either means the analysis is simply run again. SQLite takes care of
+       locking the file and of making each write atomic, so any number of
+       processes can analyze the same capture at once.'''
+
+    def __init__(self, filename, timeout=CACHE_TIMEOUT):
+        self.filename = filename
+        self.timeout = timeout
+
+    def _connect(self):
+        # connect afresh each time rather than holding on to a connection:
+        # captures (and their caches) get passed to other processes
+        connection = sqlite3.connect(self.filename, timeout=self.timeout)
+        connection.execute("CREATE TABLE IF NOT EXISTS frame_entries ("
+                           "name TEXT, params TEXT, version INTEGER, "
+                           "frame TEXT, value BLOB, "
+                           "PRIMARY KEY (name, params, version, frame))")
+        return connection
+
+    @staticmethod
+    def _get_params_key(params):
+        return json.dumps(params or {}, sort_keys=True)
+
+    def get_frames(self, name, framekeys, params=None, version=1):
+        '''Get the cached values for frames with the given keys (see
+           Capture.get_frame_key), as a dictionary of key to value. Frames
+           without a cached value are left out.'''
+        if not os.path.exists(self.filename):
+            return {}
+
+        framekeys = set(framekeys)
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT frame, value FROM frame_entries WHERE name=? AND "
+                "params=? AND version=?", (name, self._get_params_key(params),
+                                           version)).fetchall()
+        finally:
+            connection.close()
+
+        return dict((str(framekey), pickle.loads(str(value))) for
+                    (framekey, value) in rows if framekey in framekeys)
+
+    def set_frames(self, name, values, params=None, version=1):
+        '''Store values for frames, given as a dictionary of frame key to
+           value'''
+        params_key = self._get_params_key(params)
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO frame_entries VALUES "
+                    "(?, ?, ?, ?, ?)",
+                    [(name, params_key, version, framekey,
+                      sqlite3.Binary(pickle.dumps(value,
+                                                  pickle.HIGHEST_PROTOCOL)))
+                     for (framekey, value) in values.iteritems()])
+        finally:
+            connection.close()
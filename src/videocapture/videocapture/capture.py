@@ -3,13 +3,39 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from PIL import Image
+from cache import AnalysisCache
+from video import encode_video
 import StringIO
+import collections
 import os
+import re
+import tempfile
+import threading
 from zipfile import ZipFile, BadZipfile
 import json
 import numpy
 
 
+def downsample_image(im, factor):
+    '''Shrink an image by a whole factor, averaging each factor x factor
+       block of pixels. Any pixels left over at the right and bottom edges
+       are dropped.'''
+    (width, height) = (im.size[0] / factor, im.size[1] / factor)
+    return im.resize((width, height), Image.BOX,
+                     box=(0, 0, width * factor, height * factor))
+
+
+def get_downsample_params(params, downsample):
+    '''Cache parameters for results worked out from frames downsampled by
+       a factor (see downsample_image). Full resolution results keep the
+       parameters they have always had.'''
+    if downsample == 1:
+        return params
+    params = dict(params or {})
+    params['downsample'] = downsample
+    return params
+
+
 class CaptureException(Exception):
     def __init__(self, msg):
         self.msg = msg
@@ -22,8 +48,83 @@ class BadCapture(CaptureException):
     pass
 
 
+FRAME_FILENAME_RE = re.compile(r'^images/([0-9]+)\.png$')
+
+# Suffix of the (optional) raw frame store that can live alongside a
+# capture. It holds every frame of the capture as an uncompressed
+# (frames x height x width x 3) uint8 array in numpy's .npy format, so
+# frames can be read out with a memory map instead of decoding a png
+FRAMESTORE_SUFFIX = '.frames.npy'
+
+# Suffix of the cache of analysis results kept alongside a capture
+CACHE_SUFFIX = '.cache.sqlite'
+
+# Suffix of the movie encoded for a capture which was written without one
+VIDEO_SUFFIX = '.movie.webm'
+
+# Default upper bound (in bytes) on the size of the decoded frames a capture
+# keeps around for reuse: just enough for the last few frames looked at
+# (e.g. when stepping through a capture). A 720p frame as float64 is about
+# 22MB.
+DEFAULT_FRAME_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class FrameCache(object):
+    '''A least recently used cache of decoded frames, bounded by the total
+       size in bytes of the frames it holds. Safe to share between threads
+       (e.g. the webapp's, see webapp.server.handlers).'''
+
+    def __init__(self, max_size=DEFAULT_FRAME_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, key):
+        with self._lock:
+            frame = self._frames.pop(key, None)
+            if frame is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._frames[key] = frame  # now the most recently used
+            return frame
+
+    def put(self, key, frame):
+        if frame.nbytes > self.max_size:
+            return
+
+        # frames are shared between everyone asking for them, so make
+        # sure nobody modifies one behind our back
+        frame.flags.writeable = False
+        with self._lock:
+            if key in self._frames:
+                self.size -= self._frames.pop(key).nbytes
+            self._frames[key] = frame
+            self.size += frame.nbytes
+            while self.size > self.max_size:
+                (_, evicted) = self._frames.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.size = 0
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'frames': len(self._frames), 'size': self.size,
+                'maxSize': self.max_size}
+
+
 class Capture(object):
-    def __init__(self, filename):
+    def __init__(self, filename, frame_cache_size=DEFAULT_FRAME_CACHE_SIZE):
         if not os.path.exists(filename):
             raise CaptureException("Capture file '%s' does not exist!" %
                                    filename)
@@ -37,14 +138,31 @@ class Capture(object):
 
         self.metadata = json.loads(self.archive.open('metadata.json').read())
         # A cache file for storing hard-to-generate data about the capture
-        self.cache_filename = filename + '.cache'
+        self.cache_filename = filename + CACHE_SUFFIX
+        self.cache = AnalysisCache(self.cache_filename)
         if not self.metadata or not self.metadata['version']:
             raise BadCapture("Capture file '%s' does not appear to be an "
                              "Eideticker capture file" % filename)
 
-        self.num_frames = max(0, len(filter(
-            lambda s: s[0:7] == "images/" and len(s) > 8,
-            self.archive.namelist())) - 2)
+        # index the frames once up front, so we don't need to scan the
+        # archive's list of members every time we read a frame
+        self.frame_index = {}
+        for zipinfo in self.archive.infolist():
+            m = FRAME_FILENAME_RE.match(zipinfo.filename)
+            if m:
+                self.frame_index[int(m.group(1))] = zipinfo
+        # identical frames are only stored once, with the others referring
+        # to the frame they were stored under
+        for (framenum, original) in self.metadata.get('duplicateFrames',
+                                                      {}).iteritems():
+            if original not in self.frame_index:
+                raise BadCapture("Frame %s refers to missing frame %s" %
+                                 (framenum, original))
+            self.frame_index[int(framenum)] = self.frame_index[original]
+
+        self.num_frames = max(0, len(self.frame_index) - 2)
+        self.framestore = None
+        self.frame_cache = FrameCache(frame_cache_size)
         if self.num_frames > 0:
             im = self.get_frame_image(0)
             self.dimensions = im.size
@@ -52,6 +170,42 @@ class Capture(object):
         # Name of capture filename (in case we need to modify it)
         self.filename = filename
 
+        self.framestore_filename = filename + FRAMESTORE_SUFFIX
+        self._open_framestore()
+
+        self.video_filename = filename + VIDEO_SUFFIX
+
+    def __getstate__(self):
+        # captures get passed to worker processes: don't try to pickle the
+        # memory map or our decoded frames, just reopen / start afresh on
+        # the other side
+        state = self.__dict__.copy()
+        state['framestore'] = None
+        state['frame_cache'] = self.frame_cache.max_size
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.frame_cache = FrameCache(state['frame_cache'])
+        self._open_framestore()
+
+    def _open_framestore(self):
+        self.framestore = None
+        if not os.path.exists(self.framestore_filename) or \
+                os.path.getmtime(self.framestore_filename) < \
+                os.path.getmtime(self.filename):
+            return
+
+        framestore = numpy.load(self.framestore_filename, mmap_mode='r')
+        # ignore frame stores which don't match what's in the capture (e.g.
+        # ones left over from an earlier version of it)
+        if framestore.ndim == 4 and \
+                framestore.shape[0] == len(self.frame_index) and \
+                framestore.shape[3] == 3 and \
+                (self.num_frames == 0 or
+                 framestore.shape[1:3] == self.dimensions[::-1]):
+            self.framestore = framestore
+
     @property
     def fps(self):
         return self.metadata.get('fps', 60.0)
@@ -64,27 +218,119 @@ class Capture(object):
     def length(self):
         return self.num_frames / self.fps
 
+    @property
+    def has_video(self):
+        '''Whether the capture's movie is ready, either in the capture
+           itself or encoded since (see encode_video)'''
+        return 'movie.webm' in self.archive.namelist() or \
+            (os.path.exists(self.video_filename) and
+             os.path.getmtime(self.video_filename) >=
+             os.path.getmtime(self.filename))
+
     def get_video(self):
+        '''Get the capture's movie. If the capture was written without one,
+           it is encoded the first time this is called'''
         buf = StringIO.StringIO()
-        buf.write(self.archive.read('movie.webm'))
+        if 'movie.webm' in self.archive.namelist():
+            buf.write(self.archive.read('movie.webm'))
+        else:
+            if not self.has_video:
+                self.encode_video()
+            with open(self.video_filename, 'rb') as f:
+                buf.write(f.read())
         buf.seek(0)
         return buf
 
-    def get_frame_image(self, framenum, grayscale=False):
+    def encode_video(self, use_vpxenc=False):
+        '''Encode a movie of the capture's frames, and store it alongside
+           the capture'''
+        if not self.frame_index:
+            raise CaptureException("No frames in capture to encode")
+
+        images = (self._get_frame_image(self.frame_index[framenum]).convert(
+            "RGB") for framenum in sorted(self.frame_index))
+        fps = self.generated_video_fps
+        if use_vpxenc:
+            fps = self.fps
+        # encode to a temporary file first, so that nobody picks up a
+        # partly written movie
+        moviefile = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(self.video_filename)),
+            suffix='.webm', delete=False)
+        moviefile.close()
+        try:
+            status = encode_video(images, moviefile.name,
+                                  self.get_frame_image(0).size, fps,
+                                  use_vpxenc)
+            if status != 0:
+                raise CaptureException("Video encoder exited with status %s" %
+                                       status)
+            os.rename(moviefile.name, self.video_filename)
+        finally:
+            if os.path.exists(moviefile.name):
+                os.remove(moviefile.name)
+
+    def _check_framenum(self, framenum):
         if int(framenum) > self.num_frames:
             raise CaptureException("Frame number '%s' is greater than the "
                                    "number of frames (%s)" % (framenum,
                                                               self.num_frames))
 
-        filename = 'images/%s.png' % framenum
-        if filename not in self.archive.namelist():
-            raise BadCapture("Frame image '%s' not in capture" % filename)
+    def frames_identical(self, framenum1, framenum2):
+        '''Whether two frames are known to be identical without decoding
+           them: either they share the same image, or their images are the
+           same size and have the same CRC (as stored in the archive, so
+           this doesn't even need to read them)'''
+        zipinfo1 = self.frame_index.get(int(framenum1))
+        zipinfo2 = self.frame_index.get(int(framenum2))
+        if zipinfo1 is None or zipinfo2 is None:
+            return False
+        return zipinfo1 is zipinfo2 or \
+            (zipinfo1.CRC == zipinfo2.CRC and
+             zipinfo1.file_size == zipinfo2.file_size)
+
+    def get_frame_key(self, framenum):
+        '''A key identifying a frame by its contents (the CRC and size of
+           its image), under which results worked out from it are cached
+           (see AnalysisCache.get_frames)'''
+        self._check_framenum(framenum)
+        zipinfo = self.frame_index.get(int(framenum))
+        if zipinfo is None:
+            raise BadCapture("Frame image 'images/%s.png' not in capture" %
+                             framenum)
+        return '%08x:%s' % (zipinfo.CRC, zipinfo.file_size)
 
-        return self._get_frame_image(filename, grayscale)
+    def get_frame_keys(self, start, end, with_previous=False):
+        '''Keys for the frames in [start, end) (see get_frame_key). If
+           with_previous is true, each key also identifies the frame before
+           (for results worked out from both).'''
+        keys = [self.get_frame_key(i) for i in range(start, end)]
+        if with_previous:
+            # the first frame has nothing before it
+            prevkeys = [self.get_frame_key(start - 1) if start > 0 else '']
+            keys = ['%s/%s' % (prevkey, key) for (prevkey, key) in
+                    zip(prevkeys + keys, keys)]
+        return keys
 
-    def _get_frame_image(self, filename, grayscale=False):
+    def get_frame_image(self, framenum, grayscale=False):
+        self._check_framenum(framenum)
+
+        if self.framestore is not None:
+            im = Image.fromarray(self.framestore[int(framenum)])
+            if grayscale:
+                im = im.convert("L")
+            return im
+
+        zipinfo = self.frame_index.get(int(framenum))
+        if zipinfo is None:
+            raise BadCapture("Frame image 'images/%s.png' not in capture" %
+                             framenum)
+
+        return self._get_frame_image(zipinfo, grayscale)
+
+    def _get_frame_image(self, zipinfo, grayscale=False):
         buf = StringIO.StringIO()
-        buf.write(self.archive.read(filename))
+        buf.write(self.archive.read(zipinfo))
         buf.seek(0)
         im = Image.open(buf)
         if grayscale:
@@ -92,6 +338,61 @@ class Capture(object):
 
         return im
 
-    def get_frame(self, framenum, grayscale=False, type=numpy.float):
-        return numpy.array(self.get_frame_image(framenum, grayscale),
-                           dtype=type)
+    def get_frame(self, framenum, grayscale=False, type=numpy.float,
+                  downsample=1):
+        '''Get a frame as a numpy array, optionally downsampled by a whole
+           factor (see downsample_image). Note that the array returned may
+           be shared with other callers, so it should not be modified.'''
+        dtype = numpy.dtype(type)
+        if self.framestore is not None and not grayscale and \
+                dtype == self.framestore.dtype and downsample == 1:
+            # just a view into the memory map, nothing to cache
+            self._check_framenum(framenum)
+            return numpy.asarray(self.framestore[int(framenum)])
+
+        key = (int(framenum), bool(grayscale), dtype.str, int(downsample))
+        frame = self.frame_cache.get(key)
+        if frame is None:
+            if downsample != 1:
+                frame = numpy.array(downsample_image(
+                    Image.fromarray(self.get_frame(framenum, grayscale,
+                                                   numpy.uint8)),
+                    downsample), dtype=dtype)
+            elif self.framestore is not None and not grayscale:
+                self._check_framenum(framenum)
+                frame = numpy.array(self.framestore[int(framenum)],
+                                    dtype=dtype)
+            else:
+                frame = numpy.array(self.get_frame_image(framenum, grayscale),
+                                    dtype=dtype)
+            self.frame_cache.put(key, frame)
+
+        return frame
+
+
+def create_framestore(filename):
+    '''Write out a raw frame store alongside an existing capture, which
+       Capture will read frames from in preference to the images in the
+       capture itself'''
+    capture = Capture(filename)
+    if sorted(capture.frame_index.keys()) != range(len(capture.frame_index)):
+        raise BadCapture("Frames in capture '%s' are not numbered "
+                         "contiguously" % filename)
+    if not capture.num_frames:
+        raise BadCapture("No frames in capture '%s'" % filename)
+
+    (width, height) = capture.dimensions
+    tmpfilename = capture.framestore_filename + '.tmp'
+    frames = numpy.lib.format.open_memmap(
+        tmpfilename, mode='w+', dtype=numpy.uint8,
+        shape=(len(capture.frame_index), height, width, 3))
+    for (framenum, zipinfo) in capture.frame_index.iteritems():
+        frames[framenum] = numpy.array(
+            capture._get_frame_image(zipinfo).convert("RGB"))
+    frames.flush()
+    del frames
+
+    # rename into place so readers never see a partially written store
+    os.rename(tmpfilename, capture.framestore_filename)
+
+    return capture.framestore_filename
@@ -4,36 +4,49 @@
 
 import numpy
 import square
-import cPickle as pickle
 from PIL import Image
 
+# Version of the checkerboard calculation: bump this whenever it changes,
+# so that results cached by earlier versions get ignored
+CHECKERBOARD_VERSION = 1
 
-def get_checkerboarding_percents(capture):
-    try:
-        cache = pickle.load(open(capture.cache_filename, 'r'))
-    except:
-        cache = {}
-
-    try:
-        percents = cache['checkerboard_percents']
-    except:
-        percents = []
-        for i in range(1, capture.num_frames + 1):
-            frame = capture.get_frame(i, type=numpy.int16)
-            percent = 0.0
-            checkerboard_box = square.get_biggest_square((255, 0, 255), frame)
-            if checkerboard_box:
-                checkerboard_size = (checkerboard_box[2] - checkerboard_box[0]) * (checkerboard_box[3] - checkerboard_box[1])
-                percent = float(checkerboard_size) / (capture.dimensions[0] * capture.dimensions[1])
-            percents.append(percent)
-        cache['checkerboard_percents'] = percents
-        pickle.dump(cache, open(capture.cache_filename, 'w'))
-
-    return percents
-
-
-def get_checkerboarding_area_duration(capture):
-    percents = get_checkerboarding_percents(capture)
+
+def _get_checkerboard_percent(frame, dimensions, mask=None):
+    """ Fraction of a frame covered by its biggest checkerboard box. If mask
+        (a boolean array) is given, the fraction of just the pixels in it
+        covered by the biggest box inside it. """
+    percent = 0.0
+    area = dimensions[0] * dimensions[1]
+    if mask is not None:
+        # nothing outside the mask can match
+        frame = numpy.where(mask[:, :, numpy.newaxis], frame, -1)
+        area = numpy.count_nonzero(mask)
+    checkerboard_box = square.get_biggest_square((255, 0, 255), frame)
+    if checkerboard_box and area:
+        checkerboard_size = (checkerboard_box[2] - checkerboard_box[0]) * (checkerboard_box[3] - checkerboard_box[1])
+        if mask is not None:
+            checkerboard_size = numpy.count_nonzero(
+                mask[checkerboard_box[1]:checkerboard_box[3],
+                     checkerboard_box[0]:checkerboard_box[2]])
+        percent = float(checkerboard_size) / area
+
+    return percent
+
+
+def get_checkerboarding_percents(capture, max_workers=None, downsample=1,
+                                 region=None):
+    # analysis needs this module, so it can't be imported up front
+    from analysis import CheckerboardAnalyzer, get_frame_analyses
+    analyzer = CheckerboardAnalyzer(region)
+    return get_frame_analyses(capture, [analyzer], max_workers=max_workers,
+                              downsample=downsample)[analyzer.name]
+
+
+def get_checkerboarding_area_duration(capture, max_workers=None,
+                                      downsample=1, region=None):
+    percents = get_checkerboarding_percents(capture, max_workers=max_workers,
+                                            downsample=downsample,
+                                            region=region)
     total = 0
     for percent in percents:
         total += percent
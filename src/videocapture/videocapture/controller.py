@@ -4,7 +4,11 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import Queue
+import StringIO
 import concurrent.futures
+import hashlib
+import itertools
 import json
 import mozlog
 import subprocess
@@ -13,33 +17,41 @@ import time
 import datetime
 import multiprocessing
 import os
+from framebuffer import BufferedFrameSource, FrameRingBuffer
+from framesource import ImageDirectoryFrameSource, RawFrameSource
+from liveanalysis import LiveAnalysisProcess, store_live_analysis
 from square import get_biggest_square
-import re
+from video import get_video_frame_data, start_video_encoder
 import select
 import shutil
 
-from PIL import Image, ImageFilter
+from PIL import ImageFilter
 import numpy
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED
 
 DECKLINK_DIR = os.path.join(os.path.dirname(__file__), 'decklink')
 POINTGREY_DIR = os.path.join(os.path.dirname(__file__), 'pointgrey')
 MAX_VIDEO_FPS = 60
-DEFAULT_WEBM_BIT_RATE = 1024
+# how many frames apart to probe when searching for the start/end of
+# capture signals (which are always shown for much longer than this: see
+# _find_signal_end for what happens if they aren't)
+DEFAULT_SIGNAL_SEARCH_STRIDE = 15
+# how many frames to have each worker rewriting at once when converting a
+# capture: enough to keep them all busy
+FRAMES_PER_REWRITE_WORKER = 2
+# how long (in seconds) to wait for the live analysis to catch up with the
+# end of a capture before giving up on it
+LIVE_ANALYSIS_TIMEOUT = 300
 
 valid_capture_devices = ["decklink", "pointgrey"]
 valid_decklink_modes = ["720p", "1080p"]
 
 
-def _natural_key(str):
-    """See http://www.codinghorror.com/blog/archives/001018.html"""
-    return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', str)]
-
 supported_formats = {
-    "1080p": {"decklink_mode": 13},
-    "1080i": {"decklink_mode": 9},
-    "720p": {"decklink_mode": 16},
-    "720p@59.94": {"decklink_mode": 12}
+    "1080p": {"decklink_mode": 13, "dimensions": (1920, 1080)},
+    "1080i": {"decklink_mode": 9, "dimensions": (1920, 1080)},
+    "720p": {"decklink_mode": 16, "dimensions": (1280, 720)},
+    "720p@59.94": {"decklink_mode": 12, "dimensions": (1280, 720)}
 }
 
 camera_configs = {
@@ -54,7 +66,8 @@ class CaptureProcess(multiprocessing.Process):
 
     def __init__(self, capture_device, video_format, frame_counter,
                  finished_semaphore, output_raw_filename=None,
-                 outputdir=None, fps=None, camera_settings_file=None):
+                 outputdir=None, fps=None, camera_settings_file=None,
+                 frame_queue=None, frame_buffer=None):
         multiprocessing.Process.__init__(self, args=(frame_counter,
                                                      finished_semaphore,))
         self.frame_counter = frame_counter
@@ -65,6 +78,13 @@ class CaptureProcess(multiprocessing.Process):
         self.finished_semaphore = finished_semaphore
         self.fps = fps
         self.camera_settings_file = camera_settings_file
+        # if given, the number of each new frame is put on this queue (and
+        # None once the capture has finished)
+        self.frame_queue = frame_queue
+        # if given, each frame is copied into this FrameRingBuffer once it
+        # has been written (decklink only)
+        self.frame_buffer = frame_buffer
+        self.buffered_framenum = 0
 
     def stop(self):
         self.finished_semaphore.value = True
@@ -111,6 +131,9 @@ class CaptureProcess(multiprocessing.Process):
                             self.capture_device)
 
         self.capture_proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        raw_file = None
+        if self.frame_buffer is not None:
+            raw_file = open(self.output_raw_filename, 'rb')
 
         # this loop keeps track of the frame counter while the capture is
         # ongoing
@@ -123,9 +146,36 @@ class CaptureProcess(multiprocessing.Process):
                     if not line:
                         break # end of output, we're done
                     self.frame_counter.value = int(line.rstrip())
+                    if raw_file:
+                        # the capture program prints out the number of
+                        # each frame before writing it
+                        self._buffer_frames(raw_file, self.frame_counter.value)
+                    if self.frame_queue:
+                        self.frame_queue.put(self.frame_counter.value)
             except KeyboardInterrupt:
                 break
 
+        try:
+            self._terminate_capture_proc(timeout)
+            if raw_file:
+                self._buffer_frames(raw_file, os.path.getsize(
+                    self.output_raw_filename) / self.frame_buffer.frame_size)
+                raw_file.close()
+        finally:
+            if self.frame_queue:
+                self.frame_queue.put(None)
+
+    def _buffer_frames(self, raw_file, end_framenum):
+        '''Copy frames up to end_framenum (which haven't been already) from
+           the raw capture into the frame buffer'''
+        start_framenum = max(self.buffered_framenum,
+                             end_framenum - self.frame_buffer.size)
+        raw_file.seek(start_framenum * self.frame_buffer.frame_size)
+        for framenum in range(start_framenum, end_framenum):
+            self.frame_buffer.read_frame(framenum, raw_file)
+        self.buffered_framenum = max(self.buffered_framenum, end_framenum)
+
+    def _terminate_capture_proc(self, timeout):
         self.logger.debug("Terminating capture proc...")
         self.capture_proc.terminate()
         waitstart = time.time()
@@ -145,16 +195,80 @@ class CaptureProcess(multiprocessing.Process):
             pass
         self.capture_proc.wait()  # or poll and error out if still running?
 
-def _rewrite_frame(framenum, dirname, imagefilename, capture_area,
-                   capture_device):
-    im = Image.open(imagefilename)
+def _rewrite_frame(frame, capture_area, capture_device, video_format=None):
+    '''Returns the frame as PNG data, along with its raw data in
+       video_format (see video.start_video_encoder) if one is given'''
+    im = frame.get_image()
     if capture_area:
         im = im.crop(capture_area)
     # pointgrey needs a median filter because it's so noisy
     if capture_device == "pointgrey":
         im = im.filter(ImageFilter.MedianFilter())
     im = im.convert("RGB")
-    im.save(os.path.join(dirname, '%s.png' % framenum))
+    buf = StringIO.StringIO()
+    im.save(buf, 'png')
+
+    videodata = None
+    if video_format:
+        videodata = get_video_frame_data(im, video_format)
+
+    return (buf.getvalue(), videodata)
+
+def _find_signal_end(get_square, num_positions, min_position, stride,
+                     logger=None):
+    '''Find the first position (>= min_position) at which a signal square
+       which was present at the previous position has gone away.
+       get_square(position) returns the signal square at a position (or
+       None). Returns the position found and the square just before it, or
+       (None, None).
+
+       If stride is greater than one, positions are first probed stride
+       apart, and then only the run of positions the signal was shown over
+       around the last probe it was seen at is checked. That assumes the
+       signal is shown once, over a contiguous run of positions at least
+       stride long: a shorter one in between two probes can't be seen. If
+       the run found is shorter than that, or other probes saw the signal
+       too (so it came and went), or probing doesn't turn anything up,
+       every position is checked in turn.'''
+    squares = {}
+
+    def _get_square(position):
+        if position not in squares:
+            squares[position] = get_square(position)
+        return squares[position]
+
+    if stride > 1 and num_positions > 0:
+        probes = range(0, num_positions, stride) + [num_positions - 1]
+        last_present = None
+        for position in probes:
+            if _get_square(position):
+                last_present = position
+            elif last_present is not None:
+                (start, end) = (last_present, last_present + 1)
+                while start > 0 and _get_square(start - 1):
+                    start -= 1
+                while _get_square(end):
+                    end += 1
+                if end - start < stride and start > 0:
+                    if logger:
+                        logger.warn("Signal only shown for %s frames, "
+                                    "checking every frame for it" %
+                                    (end - start))
+                elif any(_get_square(probe) for probe in probes
+                         if probe < start):
+                    if logger:
+                        logger.warn("Signal shown more than once, checking "
+                                    "every frame for it")
+                elif end >= min_position:
+                    return (end, _get_square(end - 1))
+                break
+
+    for position in range(min_position, num_positions):
+        if not _get_square(position) and _get_square(position - 1):
+            return (position, _get_square(position - 1))
+
+    return (None, None)
+
 
 class CaptureController(object):
 
@@ -163,7 +277,8 @@ class CaptureController(object):
     def __init__(self, output_filename, options,
                  capture_metadata={},
                  find_start_signal=True, find_end_signal=True,
-                 custom_tempdir=None):
+                 custom_tempdir=None,
+                 signal_search_stride=DEFAULT_SIGNAL_SEARCH_STRIDE):
         self.output_filename = output_filename
         self.capture_metadata = capture_metadata
 
@@ -175,12 +290,26 @@ class CaptureController(object):
         # object
         self.capture_area = getattr(options, 'capture_area', None)
         self.use_vpxenc = getattr(options, 'use_vpxenc', False)
+        # if set, captures are written without a movie, which gets encoded
+        # when it's first asked for instead (see Capture.get_video)
+        self.defer_webm = getattr(options, 'defer_webm', False)
+        self.live_analysis = getattr(options, 'live_analysis', False)
+        self.frame_buffer_size = getattr(options, 'frame_buffer_size', None)
+        # if set, live analysis also keeps track of whether the capture has
+        # been stable for this many seconds (see capture_stable)
+        self.stable_capture_period = getattr(options, 'stable_capture_period',
+                                             None)
 
         self.find_start_signal = find_start_signal
         self.find_end_signal = find_end_signal
+        # set to 1 (or less) to check every frame for start/end signals
+        self.signal_search_stride = signal_search_stride
         self.custom_tempdir = custom_tempdir
 
         self.capture_process = None
+        self.live_analysis_process = None
+        self.stable_framenum = None
+        self.frame_buffer = None
         self.null_read = file('/dev/null', 'r')
         self.null_write = file('/dev/null', 'w')
         self.output_raw_file = None
@@ -216,6 +345,49 @@ class CaptureController(object):
         self.outputdir = tempfile.mkdtemp(dir=self.custom_tempdir)
         self.frame_counter = multiprocessing.RawValue('i', 0)
         self.finished_semaphore = multiprocessing.RawValue('b', False)
+
+        if self.frame_buffer_size:
+            if self.capture_device == 'decklink':
+                # this needs to be allocated before any of the processes
+                # sharing it are started
+                self.frame_buffer = FrameRingBuffer(
+                    supported_formats[self.mode]["dimensions"],
+                    self.frame_buffer_size)
+            else:
+                self.logger.warn("Frame buffer not supported on device "
+                                 "'%s'" % self.capture_device)
+
+        frame_queue = None
+        if self.live_analysis or self.stable_capture_period:
+            if self.capture_device == 'decklink':
+                # analyze frames as they come in from the raw capture,
+                # reading them out of the frame buffer where we can
+                frames = RawFrameSource(
+                    output_raw_filename,
+                    supported_formats[self.mode]["dimensions"])
+                if self.frame_buffer is not None:
+                    frames = BufferedFrameSource(self.frame_buffer, frames)
+                stable_frames = None
+                if self.stable_capture_period:
+                    self.stable_framenum = multiprocessing.RawValue('i', -1)
+                    stable_frames = int(self.stable_capture_period *
+                                        (self.fps or 60))
+                frame_queue = multiprocessing.Queue()
+                self.live_results_queue = multiprocessing.Queue()
+                self.live_analysis_process = LiveAnalysisProcess(
+                    frames, frame_queue, self.live_results_queue,
+                    capture_area=self.capture_area,
+                    find_start_signal=self.find_start_signal,
+                    ignored_areas=self.capture_metadata.get('ignoreAreas'),
+                    stable_framenum=self.stable_framenum,
+                    stable_frames=stable_frames)
+                self.live_analysis_process.start()
+            else:
+                # the pointgrey capture program only writes out its frames
+                # once the capture has finished
+                self.logger.warn("Live analysis not supported on device "
+                                 "'%s'" % self.capture_device)
+
         self.capture_process = CaptureProcess(
             self.capture_device, self.mode,
             self.frame_counter,
@@ -223,7 +395,9 @@ class CaptureController(object):
             output_raw_filename=output_raw_filename,
             outputdir=self.outputdir,
             fps=self.fps,
-            camera_settings_file=self.camera_settings_file)
+            camera_settings_file=self.camera_settings_file,
+            frame_queue=frame_queue,
+            frame_buffer=self.frame_buffer)
         self.logger.info("Starting capture...")
         self.capture_process.start()
 
@@ -239,6 +413,7 @@ class CaptureController(object):
                 self.logger.error("Timed out waiting for first frame! Capture "
                                   "program hung?")
                 self.terminate_capture()
+                self._stop_live_analysis()
                 raise Exception("Timed out waiting for first frame")
 
     @property
@@ -249,6 +424,23 @@ class CaptureController(object):
         assert self.capture_process
         return self.frame_counter.value
 
+    def capture_stable(self):
+        '''Whether the capture has been stable for the stable capture period
+           (always False if that wasn't set)'''
+        return self.stable_framenum is not None and \
+            self.stable_framenum.value >= 0
+
+    def get_buffered_frame(self, framenum=-1):
+        '''Get a frame of an ongoing capture (by default the latest one) out
+           of the frame buffer, as an RGB array. Returns None if there is no
+           frame buffer or the frame is not in it.'''
+        if self.frame_buffer is None:
+            return None
+        try:
+            return self.frame_buffer[framenum].get_array()
+        except IndexError:
+            return None
+
     def terminate_capture(self):
         # should not call this when no capture is ongoing
         if not self.capturing:
@@ -259,6 +451,55 @@ class CaptureController(object):
         self.capture_process.join()
         self.capture_process = None
 
+    def _get_live_analysis_results(self, timeout=LIVE_ANALYSIS_TIMEOUT):
+        '''Wait for the results of the live analysis, then stop it. Returns
+           None if the analysis failed, or didn't finish in time.'''
+        results = None
+        deadline = time.time() + timeout
+        while True:
+            # anything put on the queue before the process exited can still
+            # be read afterwards
+            alive = self.live_analysis_process.is_alive()
+            try:
+                results = self.live_results_queue.get(timeout=1)
+                break
+            except Queue.Empty:
+                if not alive:
+                    self.logger.error("Live analysis exited without "
+                                      "sending any results")
+                    break
+                if time.time() > deadline:
+                    self.logger.error("Timed out waiting for live analysis")
+                    break
+
+        self._stop_live_analysis()
+        return results
+
+    def _stop_live_analysis(self):
+        if not self.live_analysis_process:
+            return
+
+        # a result still on its way would stop the process from exiting
+        try:
+            while True:
+                self.live_results_queue.get_nowait()
+        except Queue.Empty:
+            pass
+        self.live_analysis_process.join(5)
+        if self.live_analysis_process.is_alive():
+            self.live_analysis_process.terminate()
+            self.live_analysis_process.join()
+        self.live_analysis_process = None
+
+    def _get_frame_source(self):
+        if self.capture_device == "decklink":
+            # read frames straight out of the raw capture
+            return RawFrameSource(
+                self.output_raw_file.name,
+                supported_formats[self.mode]["dimensions"])
+
+        return ImageDirectoryFrameSource(self.outputdir)
+
     def convert_capture(self, start_frame, end_frame, create_webm=True):
         self.logger.info("Converting capture...")
         # wait for capture to finish if it has not already
@@ -267,63 +508,56 @@ class CaptureController(object):
             while self.capturing:
                 time.sleep(0.5)
 
-        if self.capture_device == "decklink":
-            subprocess.Popen((
-                os.path.join(DECKLINK_DIR, 'decklink-convert.sh'),
-                self.output_raw_file.name, self.outputdir, self.mode),
-                close_fds=True).wait()
-
         self.logger.info("Gathering capture dimensions and cropping to "
                          "start/end of capture...")
-        imagefiles = [os.path.join(self.outputdir, path) for path in
-                      sorted(os.listdir(self.outputdir), key=_natural_key)]
-        num_frames = len(imagefiles)
+        frames = self._get_frame_source()
+        num_frames = len(frames)
 
         # full image dimensions
         frame_dimensions = (0, 0)
         if num_frames > 0:
-            im = Image.open(imagefiles[0])
-            frame_dimensions = im.size
+            frame_dimensions = frames.dimensions
 
         # searching for start/end frames and capture dimensions only really
         # makes sense on the decklink cards, which have a clean HDMI signal.
         # input from things like the pointgrey cameras is too noisy...
         if self.capture_device == "decklink":
+            def _get_square(rgb, framenum):
+                imgarray = numpy.array(frames[framenum].get_array(),
+                                       dtype=numpy.int16)
+                return get_biggest_square(rgb, imgarray)
+
             # start frame
             if self.find_start_signal:
                 self.logger.info("Searching for start of capture signal ...")
-                squares = []
-                for (i, imagefile) in enumerate(imagefiles):
-                    imgarray = numpy.array(Image.open(imagefile),
-                                           dtype=numpy.int16)
-                    squares.append(get_biggest_square((0, 255, 0), imgarray))
-                    if i > 1 and not squares[-1] and squares[-2]:
-                        if not start_frame:
-                            start_frame = i
-                        self.capture_area = squares[-2]
-                        self.logger.info("Found start capture signal at frame "
-                                         "%s. Area: %s" %
-                                         (i, self.capture_area))
-                        break
+                (i, square) = _find_signal_end(
+                    lambda i: _get_square((0, 255, 0), i), num_frames, 2,
+                    self.signal_search_stride, self.logger)
+                if i is not None:
+                    if not start_frame:
+                        start_frame = i
+                    self.capture_area = square
+                    self.logger.info("Found start capture signal at frame "
+                                     "%s. Area: %s" % (i, self.capture_area))
 
             # end frame
             if self.find_end_signal:
                 self.logger.info("Searching for end of capture signal ...")
-                squares = []
-                for i in range(num_frames - 1, 0, -1):
-                    imgarray = numpy.array(Image.open(imagefiles[i]),
-                                           dtype=numpy.int16)
-                    squares.append(get_biggest_square((255, 0, 0), imgarray))
-
-                    if len(squares) > 1 and not squares[-1] and squares[-2]:
-                        if not end_frame:
-                            end_frame = (i - 1)
-                        if not self.capture_area:
-                            self.capture_area = squares[-2]
-                        self.logger.info("Found end capture signal at frame "
-                                         "%s. Area: %s" % (i - 1,
-                                                           self.capture_area))
-                        break
+                # search backwards from the last frame
+                (position, square) = _find_signal_end(
+                    lambda position: _get_square((255, 0, 0),
+                                                 num_frames - 1 - position),
+                    num_frames - 1, 1, self.signal_search_stride,
+                    self.logger)
+                if position is not None:
+                    i = num_frames - 1 - position
+                    if not end_frame:
+                        end_frame = (i - 1)
+                    if not self.capture_area:
+                        self.capture_area = square
+                    self.logger.info("Found end capture signal at frame "
+                                     "%s. Area: %s" % (i - 1,
+                                                       self.capture_area))
 
         # If we don't have a start frame, set it to 1
         if not start_frame:
@@ -333,30 +567,20 @@ class CaptureController(object):
         if not end_frame:
             end_frame = num_frames
 
-        self.logger.info("Rewriting images in %s..." % self.outputdir)
-        rewritten_imagedir = tempfile.mkdtemp(dir=self.custom_tempdir)
-
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            # map the frame before the start frame to the zeroth frame (if
-            # possible). HACK: otherwise, create a copy of the start
-            # frame (this duplicates a frame).
-            remapped_frame = 0
-            if start_frame > 1:
-                remapped_frame = start_frame - 1
-            executor.submit(_rewrite_frame,
-                            0, rewritten_imagedir, imagefiles[remapped_frame],
-                            self.capture_area, self.capture_device)
-
-            # last frame is the specified end frame or the first red frame if
-            # no last frame specified, or the very last frame in the
-            # sequence if there is no red frame and no specified last frame
-            last_frame = min(num_frames - 1, end_frame + 2)
-
-            # copy the remaining frames into numeric order starting from 1
-            for (i, j) in enumerate(range(start_frame, last_frame)):
-                executor.submit(_rewrite_frame, (i + 1),
-                                rewritten_imagedir, imagefiles[j],
-                                self.capture_area, self.capture_device)
+        # map the frame before the start frame to the zeroth frame (if
+        # possible). HACK: otherwise, create a copy of the start frame (this
+        # duplicates a frame).
+        remapped_frame = 0
+        if start_frame > 1:
+            remapped_frame = start_frame - 1
+
+        # last frame is the specified end frame or the first red frame if
+        # no last frame specified, or the very last frame in the
+        # sequence if there is no red frame and no specified last frame
+        last_frame = min(num_frames - 1, end_frame + 2)
+
+        # the remaining frames go into numeric order starting from 1
+        source_framenums = [remapped_frame] + range(start_frame, last_frame)
 
         capturefps = self.fps
         if not capturefps:
@@ -365,61 +589,113 @@ class CaptureController(object):
         if generated_video_fps > MAX_VIDEO_FPS:
             generated_video_fps = MAX_VIDEO_FPS
 
-        if create_webm:
-            self.logger.info("Creating movie ...")
-
-            moviefile = tempfile.NamedTemporaryFile(dir=self.custom_tempdir,
-                                                    suffix=".webm")
-            # png2yuv is broken on Ubuntu 12.04 and earlier, so we can't use
-            # vpxenc there by default
-            if self.use_vpxenc:
-                with tempfile.NamedTemporaryFile(dir=self.custom_tempdir) as yuvfile:
-                    yuvconv = subprocess.Popen(('png2yuv', '-I',  'p', '-f',
-                                                str(capturefps), '-n',
-                                                str(last_frame-start_frame), '-j',
-                                                '%s/%%d.png' % rewritten_imagedir),
-                                               stdout=subprocess.PIPE)
-                    while yuvconv.poll() == None:
-                        yuvfile.write(yuvconv.stdout.read())
-                    yuvfile.write(yuvconv.stdout.read())
-                    yuvfile.flush()
-
-                    subprocess.Popen(('vpxenc', '--good', '--cpu-used=0',
-                                      '--end-usage=vbr', '--passes=2',
-                                      '--threads=%s' % (multiprocessing.cpu_count() - 1),
-                                      '--target-bitrate=%s' % DEFAULT_WEBM_BIT_RATE,
-                                      '-o', moviefile.name, yuvfile.name)).wait()
-            else:
-                subprocess.Popen(('avconv', '-y', '-r', str(generated_video_fps), '-i',
-                                  os.path.join(rewritten_imagedir, '%d.png'),
-                                  moviefile.name), close_fds=True).wait()
-
-
         self.logger.info("Writing final capture '%s'..." %
                          self.output_filename)
         zipfile = ZipFile(self.output_filename, 'a')
 
-        zipfile.writestr('metadata.json',
-                         json.dumps(dict({ 'captureDevice': self.capture_device,
-                                           'date': datetime.datetime.now().isoformat(),
-                                           'frameDimensions': frame_dimensions,
-                                           'fps': capturefps,
-                                           'generatedVideoFPS': generated_video_fps,
-                                           'version': 1 },
-                                         **self.capture_metadata)))
-        if create_webm:
+        # the movie is encoded from the rewritten frames as they are written
+        # into the capture
+        (encoder, video_format) = (None, None)
+        if create_webm and self.defer_webm:
+            self.logger.info("Deferring creation of movie until it's needed")
+        elif create_webm:
+            self.logger.info("Creating movie ...")
+            moviefile = tempfile.NamedTemporaryFile(dir=self.custom_tempdir,
+                                                    suffix=".webm")
+            movie_dimensions = frame_dimensions
+            if self.capture_area:
+                (x1, y1, x2, y2) = self.capture_area
+                movie_dimensions = (x2 - x1, y2 - y1)
+            (encoder, video_format) = start_video_encoder(
+                moviefile.name, movie_dimensions,
+                capturefps if self.use_vpxenc else generated_video_fps,
+                self.use_vpxenc)
+
+        max_workers = multiprocessing.cpu_count()
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+            # only a few frames per worker are rewritten at a time, so we
+            # never hold on to more than that many at once (counting those
+            # waiting for the encoder to get to them)
+            max_frames = max_workers * FRAMES_PER_REWRITE_WORKER
+            unsubmitted = enumerate(source_framenums)
+            futures = {}
+            # frames go into the capture as soon as they have been
+            # rewritten, but need to be fed to the encoder in order
+            videoframes = {}
+            # identical frames (e.g. of an idle screen) are only stored
+            # once, the others just refer to that frame in the metadata
+            stored_frames = {}
+            duplicate_frames = {}
+            next_videoframe = 0
+            while True:
+                for (i, j) in itertools.islice(
+                        unsubmitted,
+                        max_frames - len(futures) - len(videoframes)):
+                    futures[executor.submit(_rewrite_frame, frames[j],
+                                            self.capture_area,
+                                            self.capture_device,
+                                            video_format)] = i
+                if not futures:
+                    break
+
+                (done, _) = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    i = futures.pop(future)
+                    (imagedata, videodata) = future.result()
+                    digest = hashlib.sha1(imagedata).digest()
+                    if digest in stored_frames:
+                        duplicate_frames[i] = stored_frames[digest]
+                    else:
+                        stored_frames[digest] = i
+                        # PNGs are already compressed, no point deflating
+                        # them again
+                        zipfile.writestr("images/%s.png" % i, imagedata,
+                                         ZIP_STORED)
+                    if encoder:
+                        videoframes[i] = videodata
+                        while next_videoframe in videoframes:
+                            encoder.stdin.write(
+                                videoframes.pop(next_videoframe))
+                            next_videoframe += 1
+
+        if encoder:
+            encoder.stdin.close()
+            if encoder.wait() != 0:
+                self.logger.warn("Video encoder exited with status %s" %
+                                 encoder.returncode)
             zipfile.writestr('movie.webm', moviefile.read())
 
-        for imagefilename in os.listdir(rewritten_imagedir):
-            zipfile.writestr("images/%s" % imagefilename,
-                             open(os.path.join(rewritten_imagedir,
-                                               imagefilename)).read())
+        metadata = dict({ 'captureDevice': self.capture_device,
+                          'date': datetime.datetime.now().isoformat(),
+                          'frameDimensions': frame_dimensions,
+                          'fps': capturefps,
+                          'generatedVideoFPS': generated_video_fps,
+                          'version': 1 },
+                        **self.capture_metadata)
+        if duplicate_frames:
+            metadata['duplicateFrames'] = duplicate_frames
+        zipfile.writestr('metadata.json', json.dumps(metadata))
 
         zipfile.close()
         self.logger.info("Wrote out final capture.")
 
+        if self.live_analysis_process:
+            self.logger.info("Waiting for live analysis to finish...")
+            live_results = self._get_live_analysis_results()
+            if live_results is None:
+                self.logger.info("No results from live analysis, not "
+                                 "storing them.")
+            elif store_live_analysis(live_results, self.output_filename,
+                                     self.capture_area,
+                                     self.capture_metadata.get('ignoreAreas'),
+                                     source_framenums):
+                self.logger.info("Stored results of live analysis.")
+            else:
+                self.logger.info("Results of live analysis don't match the "
+                                 "final capture, not storing them.")
+
         shutil.rmtree(self.outputdir)
-        shutil.rmtree(rewritten_imagedir)
         if self.output_raw_file:
             # closing the file should delete it
             self.output_raw_file.close()
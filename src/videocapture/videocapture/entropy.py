@@ -1,17 +1,13 @@
-from itertools import repeat
+from capture import get_downsample_params
 from scipy import ndimage
-import cPickle as pickle
 import cv2
-import math
-import concurrent.futures
 import numpy
 
-def _get_frame_entropy((i, capture, edge_detection)):
-    """ Function calculates and returns the entropy of a single frame.
-        Values for edge_detection can be 'sobel', 'canny' and None. """
-
-    frame = capture.get_frame(i, True).astype('uint8') #ndarray is float64 by default
+# Version of the entropy calculation: bump this whenever it changes, so
+# that results cached by earlier versions get ignored
+ENTROPY_VERSION = 1
 
+def _get_edges(frame, edge_detection):
     if edge_detection=='sobel':
         frame = ndimage.median_filter(frame, 3)
 
@@ -22,36 +18,56 @@ def _get_frame_entropy((i, capture, edge_detection)):
     elif edge_detection=='canny':
         frame = cv2.Canny(frame,100,200) # Using set params at the moment
 
-    histogram = numpy.histogram(frame, bins=256)[0]
-    histogram_length = sum(histogram)
-    samples_probability = [float(h) / histogram_length for h in histogram]
-    entropy = -sum([p * math.log(p, 2) for p in samples_probability if p != 0])
+    return frame
 
-    return entropy
+def _get_histogram(frame):
+    if frame.dtype == numpy.uint8:
+        # one bin per value. this gives the same counts as a 256 bin
+        # numpy.histogram over the range of values in the frame (only
+        # ordered differently), which doesn't matter for the entropy
+        return numpy.bincount(frame.ravel(), minlength=256)
+    return numpy.histogram(frame, bins=256)[0]
 
-def get_frame_entropies(capture, edge_detection=None):
-    try:
-        cache = pickle.load(open(capture.cache_filename, 'r'))
-    except:
-        cache = {}
+def get_histogram_entropies(histograms):
+    """ Entropies of histograms (along the last axis of an array) """
+    histograms = numpy.asarray(histograms, dtype=numpy.float)
+    totals = histograms.sum(axis=-1)[..., numpy.newaxis]
+    probabilities = histograms / numpy.where(totals > 0, totals, 1)
+    logs = numpy.log2(numpy.where(probabilities > 0, probabilities, 1))
+    return -(probabilities * logs).sum(axis=-1)
 
-    cachekey = 'frame_entropies'
-    if edge_detection=='sobel':
-        cachekey += '_sobel'
-    elif edge_detection=='canny':
-        cachekey += '_canny'
-
-    if cache.get(cachekey):
-        return cache[cachekey]
-
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        entropies = list(executor.map(_get_frame_entropy,
-                                      zip(range(capture.num_frames+1),
-                                          repeat(capture),
-                                          repeat(edge_detection))))
-        cache[cachekey] = entropies
-    pickle.dump(cache, open(capture.cache_filename, 'w'))
-    return cache[cachekey]
+def _get_entropy(frame, edge_detection=None, mask=None):
+    """ Entropy of a grayscale (uint8) frame, optionally after edge
+        detection. If mask (a boolean array) is given, only the pixels in
+        it are counted. """
+    edges = _get_edges(frame, edge_detection)
+    if mask is not None:
+        edges = edges[mask]
+    return float(get_histogram_entropies(_get_histogram(edges)))
+
+def get_entropies(frames, edge_detection=None):
+    """ Entropies of a stack of grayscale (uint8) frames (e.g. an array of
+        frames x height x width), calculated together """
+    histograms = numpy.zeros((len(frames), 256), dtype=numpy.int64)
+    for (i, frame) in enumerate(frames):
+        histograms[i] = _get_histogram(_get_edges(frame, edge_detection))
+
+    return get_histogram_entropies(histograms).tolist()
+
+def _get_entropy_params(edge_detection, downsample=1):
+    return get_downsample_params({'edgeDetection': edge_detection},
+                                 downsample)
+
+def get_frame_entropies(capture, edge_detection=None, downsample=1,
+                        region=None):
+    """ Entropy of each frame of a capture, optionally worked out from the
+        frames downsampled by a factor (see Capture.get_frame), or from
+        just a region of them (see regions) """
+    # analysis needs this module, so it can't be imported up front
+    from analysis import EntropyAnalyzer, get_frame_analyses
+    analyzer = EntropyAnalyzer(edge_detection, region)
+    return get_frame_analyses(capture, [analyzer],
+                              downsample=downsample)[analyzer.name]
 
 def get_overall_entropy(capture, edge_detection=None):
     return sum(get_frame_entropies(capture, edge_detection))
@@ -0,0 +1,163 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# A ring buffer of the most recent frames of a capture, in shared memory.
+# The capture process copies each frame into it as soon as it has been
+# written, so that other processes (the controller, live analysis) can get
+# at recent frames without going back to the raw capture file.
+
+from PIL import Image
+from framesource import uyvy_rows_to_rgb
+import multiprocessing
+import numpy
+
+# number of frames kept by default (about 110MB at 720p, 250MB at 1080p)
+DEFAULT_FRAME_BUFFER_SIZE = 60
+
+
+class FrameRingBuffer(object):
+    '''The last size frames of a raw (8-bit 4:2:2 YUV) decklink capture.
+       The buffer is allocated up front, so it has to be created before any
+       processes which use it are started.
+
+       Frames are written by a single process (with put or read_frame),
+       and can be read by any number of others. Readers get a copy of a
+       frame (see __getitem__), or a view straight onto the buffer (see
+       get_raw_view) which they need to check is still valid once they are
+       done with it.'''
+
+    def __init__(self, dimensions, size=DEFAULT_FRAME_BUFFER_SIZE):
+        (self.width, self.height) = self.dimensions = tuple(dimensions)
+        self.size = size
+        self.frame_size = self.width * self.height * 2
+        self._buffer = multiprocessing.RawArray('B', size * self.frame_size)
+        # the number of the frame in each slot (-1 if the slot is empty or
+        # being written to)
+        self._slot_framenums = multiprocessing.RawArray('i', [-1] * size)
+        self._latest_framenum = multiprocessing.RawValue('i', -1)
+        self._slots = None
+
+    def __getstate__(self):
+        # numpy views of the buffer are created again in each process
+        state = self.__dict__.copy()
+        state['_slots'] = None
+        return state
+
+    def _get_slot(self, framenum):
+        if self._slots is None:
+            self._slots = numpy.frombuffer(self._buffer,
+                                           dtype=numpy.uint8).reshape(
+                self.size, self.height, self.width * 2)
+        return self._slots[framenum % self.size]
+
+    def _begin_write(self, framenum):
+        self._slot_framenums[framenum % self.size] = -1
+        return self._get_slot(framenum)
+
+    def _end_write(self, framenum):
+        self._slot_framenums[framenum % self.size] = framenum
+        self._latest_framenum.value = max(self._latest_framenum.value,
+                                          framenum)
+
+    def put(self, framenum, data):
+        '''Store the raw data of a frame'''
+        slot = self._begin_write(framenum)
+        slot.flat[:] = numpy.frombuffer(data, dtype=numpy.uint8)
+        self._end_write(framenum)
+
+    def read_frame(self, framenum, f):
+        '''Store a frame read from the current position of a file'''
+        slot = self._begin_write(framenum)
+        if f.readinto(slot) != self.frame_size:
+            raise IOError("Frame %s not completely written" % framenum)
+        self._end_write(framenum)
+
+    def __len__(self):
+        # like the other frame sources, the number of frames captured so
+        # far (not all of which are still in the buffer)
+        return self._latest_framenum.value + 1
+
+    def contains(self, framenum):
+        return framenum >= 0 and \
+            self._slot_framenums[framenum % self.size] == framenum
+
+    def get_raw_view(self, framenum):
+        '''A read-only view onto a frame's raw data in the buffer, without
+           copying it. The frame will be overwritten once size more frames
+           have been captured: call contains(framenum) once done with the
+           view to check that this hasn't happened yet.'''
+        if not self.contains(framenum):
+            raise IndexError("Frame %s not in buffer" % framenum)
+        view = self._get_slot(framenum)[:]
+        view.flags.writeable = False
+        return view
+
+    def __getitem__(self, framenum):
+        if framenum < 0:
+            framenum += len(self)
+        if not self.contains(framenum):
+            raise IndexError("Frame %s not in buffer" % framenum)
+        return BufferedFrame(self, framenum)
+
+
+class BufferedFrame(object):
+    '''A single frame in a FrameRingBuffer'''
+
+    def __init__(self, framebuffer, framenum):
+        self.framebuffer = framebuffer
+        self.framenum = framenum
+
+    def get_array(self, area=None):
+        '''Get the frame (or just area of it) as an RGB array. Raises
+           IndexError if the frame has been overwritten in the meantime.'''
+        (x1, y1, x2, y2) = area or (0, 0, self.framebuffer.width,
+                                    self.framebuffer.height)
+        rows = numpy.array(self.framebuffer.get_raw_view(self.framenum)[y1:y2])
+        if not self.framebuffer.contains(self.framenum):
+            raise IndexError("Frame %s overwritten while being read" %
+                             self.framenum)
+        return uyvy_rows_to_rgb(rows, (x1, x2))
+
+    def get_image(self):
+        return Image.fromarray(self.get_array())
+
+
+class BufferedFrameSource(object):
+    '''Frames from a FrameRingBuffer where possible, falling back to
+       another frame source (e.g. the raw capture file) for frames which
+       are no longer in the buffer'''
+
+    def __init__(self, framebuffer, frames):
+        self.framebuffer = framebuffer
+        self.frames = frames
+        self.dimensions = framebuffer.dimensions
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, framenum):
+        if framenum < 0:
+            framenum += len(self)
+        if self.framebuffer.contains(framenum):
+            return _FallbackFrame(BufferedFrame(self.framebuffer, framenum),
+                                  self.frames[framenum])
+        return self.frames[framenum]
+
+
+class _FallbackFrame(object):
+    '''A buffered frame which is read from elsewhere if it gets overwritten
+       before it can be read'''
+
+    def __init__(self, frame, fallback):
+        self.frame = frame
+        self.fallback = fallback
+
+    def get_array(self, area=None):
+        try:
+            return self.frame.get_array(area)
+        except IndexError:
+            return self.fallback.get_array(area)
+
+    def get_image(self):
+        return Image.fromarray(self.get_array())
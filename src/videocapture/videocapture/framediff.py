@@ -3,9 +3,9 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from PIL import Image
-from itertools import repeat
-import cPickle as pickle
-import concurrent.futures
+from capture import get_downsample_params
+from entropy import get_histogram_entropies
+from frameresults import get_cached_frame_results
 import math
 import numpy
 
@@ -15,6 +15,34 @@ import numpy
 # of eliminating frame differences due to "noise" in the capture
 PIXEL_DIFF_THRESHOLD = 5.0
 
+# Version of the frame difference calculation: bump this whenever it
+# changes, so that results cached by earlier versions get ignored
+FRAMEDIFF_VERSION = 2
+
+
+def _get_framediff_params(ignored_areas, filter_threshold, downsample=1):
+    return get_downsample_params({'ignoreAreas': ignored_areas,
+                                  'filterThreshold': filter_threshold},
+                                 downsample)
+
+
+def _get_framediff_histogram_params(ignored_areas, downsample=1):
+    return get_downsample_params({'ignoreAreas': ignored_areas}, downsample)
+
+
+def _get_ignored_areas(capture):
+    if capture.metadata.get('ignoreAreas'):
+        return capture.metadata['ignoreAreas']
+    return []
+
+
+def _downsample_areas(areas, factor):
+    """ Areas ([x1, y1, x2, y2]) of a frame in the same frame downsampled by
+        a factor. Any block of pixels partly in an area is counted as being
+        in it. """
+    return [[x1 // factor, y1 // factor, -(-x2 // factor), -(-y2 // factor)]
+            for (x1, y1, x2, y2) in areas]
+
 
 def get_framediff_imgarray(capture, framenum1, framenum2,
                            filter_low_differences=True, cropped=False):
@@ -22,31 +50,22 @@ def get_framediff_imgarray(capture, framenum1, framenum2,
     if filter_low_differences:
         filter_threshold = PIXEL_DIFF_THRESHOLD
 
-    if capture.metadata.get('ignoreAreas'):
-        ignored_areas = capture.metadata['ignoreAreas']
-    else:
-        ignored_areas = []
+    ignored_areas = _get_ignored_areas(capture)
 
     frame1 = capture.get_frame(framenum1, cropped)
     frame2 = capture.get_frame(framenum2, cropped)
     framediff = numpy.abs(frame1.astype('float') - frame2.astype('float'))
-    for (y, row) in enumerate(framediff):
-        for (x, px) in enumerate(row):
-            skip = False
-            for ignored_area in ignored_areas:
-                if y >= ignored_area[1] and y < ignored_area[3] and \
-                        x >= ignored_area[0] and x < ignored_area[2]:
-                    skip = True
-                    break
-
-            if not skip and (px[0] >= filter_threshold or
-                             px[1] >= filter_threshold or
-                             px[2] >= filter_threshold):
-                px[0] = 255.0
-                px[1] = 0.0
-                px[2] = 0.0
-            else:
-                px[0] = px[1] = px[2] = 0.0
+
+    # pixels where any component differs by at least the threshold, and
+    # which aren't in an area we're ignoring, are painted red: everything
+    # else is black
+    changed = (framediff >= filter_threshold).any(axis=2)
+    for ignored_area in ignored_areas:
+        changed[max(0, ignored_area[1]):max(0, ignored_area[3]),
+                max(0, ignored_area[0]):max(0, ignored_area[2])] = False
+
+    framediff[:] = 0.0
+    framediff[changed, 0] = 255.0
 
     return framediff
 
@@ -57,65 +76,112 @@ def get_framediff_image(capture, framenum1, framenum2, cropped=False):
     return Image.fromarray(framediff.astype(numpy.uint8))
 
 
-def _get_framediff_sum((i, capture, ignored_areas, filter_threshold)):
-    frame1 = capture.get_frame(i-1, True).astype('float')
-    frame2 = capture.get_frame(i, True).astype('float')
-
-    framediff = abs(frame2 - frame1)
+def _get_framediff_sum(frame1, frame2, ignored_areas, filter_threshold,
+                       mask=None):
+    framediff = numpy.abs(frame2 - frame1)
     for ignored_area in ignored_areas:
-        for x in range(ignored_area[0], ignored_area[2]):
-            for y in range(ignored_area[1], ignored_area[3]):
-                framediff[x][y] = 0.0
-    return len(framediff[framediff >= filter_threshold])
-
-def get_framediff_sums(capture, filter_low_differences=True):
-    filter_threshold = 0
-    if filter_low_differences:
-        filter_threshold = PIXEL_DIFF_THRESHOLD
-
-    try:
-        cache = pickle.load(open(capture.cache_filename, 'r'))
-    except:
-        cache = {}
-
-    if capture.metadata.get('ignoreAreas'):
-        ignored_areas = capture.metadata['ignoreAreas']
-    else:
-        ignored_areas = []
-
-    try:
-        diffsums = cache['diffsums']
-    except:
-        # Frame differences
-        diffsums = None
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            diffsums = [0] + list(executor.map(_get_framediff_sum,
-                                               zip(range(1, capture.num_frames + 1),
-                                                   repeat(capture), repeat(ignored_areas),
-                                                   repeat(filter_threshold))))
-            cache['diffsums'] = diffsums
-        pickle.dump(cache, open(capture.cache_filename, 'w'))
+        framediff[max(0, ignored_area[1]):max(0, ignored_area[3]),
+                  max(0, ignored_area[0]):max(0, ignored_area[2])] = 0.0
+    if mask is not None:
+        framediff = framediff[mask]
+    return int(numpy.count_nonzero(framediff >= filter_threshold))
+
+
+def _get_framediff_histogram(frame1, frame2, ignored_areas, mask=None):
+    """ Histogram of how much each pixel differs between two grayscale
+        frames (pixels in ignored areas count as not differing at all), as
+        256 counts. If mask (a boolean array) is given, only the pixels in
+        it are counted. """
+    framediff = numpy.abs(frame2 - frame1)
+    for ignored_area in ignored_areas:
+        framediff[max(0, ignored_area[1]):max(0, ignored_area[3]),
+                  max(0, ignored_area[0]):max(0, ignored_area[2])] = 0.0
+    if mask is not None:
+        framediff = framediff[mask]
+    return numpy.bincount(framediff.astype(numpy.uint8).ravel(),
+                          minlength=256).astype(numpy.uint32)
+
+
+def get_framediff_histograms(capture, downsample=1, region=None):
+    """ Histograms of how much each pixel of each frame differs from the
+        previous frame (see _get_framediff_histogram), as an array of
+        frames x 256 counts. The first frame's histogram is all zeros.
+        If downsample is given, frames are compared after being shrunk by
+        that factor (see Capture.get_frame), so the counts are of blocks of
+        pixels rather than pixels. If region is given, only the pixels in
+        the capture's region of that name are counted (see regions). """
+    if capture.num_frames == 0:
+        return numpy.zeros((1, 256), dtype=numpy.uint32)
+
+    # analysis needs this module, so it can't be imported up front
+    from analysis import FrameDifferenceHistogramAnalyzer, get_frame_analyses
+    analyzer = FrameDifferenceHistogramAnalyzer(region=region)
+    histograms = get_frame_analyses(capture, [analyzer],
+                                    downsample=downsample)[analyzer.name]
+
+    return numpy.asarray(histograms, dtype=numpy.uint32)
+
+
+def get_framediff_counts(histograms, filter_threshold):
+    """ Number of pixels in each frame which differ from the previous frame
+        by at least filter_threshold, from frame difference histograms """
+    first_bin = max(0, int(math.ceil(filter_threshold)))
+    return [int(count) for count in
+            numpy.asarray(histograms)[:, first_bin:].sum(axis=1)]
+
+
+def get_framediff_sums(capture, filter_low_differences=True,
+                       filter_threshold=None, downsample=1, region=None):
+    """ Number of pixels in each frame which differ from the previous
+        frame. Differences below filter_threshold (by default
+        PIXEL_DIFF_THRESHOLD, or nothing if filter_low_differences is
+        false) are ignored. See get_framediff_histograms for downsample
+        and region. """
+    if filter_threshold is None:
+        filter_threshold = 0
+        if filter_low_differences:
+            filter_threshold = PIXEL_DIFF_THRESHOLD
+
+    if region:
+        # these are only cached for whole frames, the histograms they're
+        # worked out from are cached either way
+        return get_framediff_counts(get_framediff_histograms(
+            capture, downsample, region), filter_threshold)
+
+    params = _get_framediff_params(_get_ignored_areas(capture),
+                                   filter_threshold, downsample)
+    (framekeys, diffsums, missing) = get_cached_frame_results(
+        capture, 'diffsums', 0, params, FRAMEDIFF_VERSION, with_previous=True)
+    if missing:
+        # worked out from the frame difference histograms, so this doesn't
+        # need to decode any frames again if we have those for another
+        # threshold
+        diffsums = get_framediff_counts(get_framediff_histograms(capture,
+                                                                 downsample),
+                                        filter_threshold)
+        capture.cache.set_frames('diffsums', dict(zip(framekeys, diffsums)),
+                                 params, FRAMEDIFF_VERSION)
 
     return diffsums
 
 def image_entropy(img):
     """calculate the entropy of an image"""
     # based on: http://brainacle.com/calculating-image-entropy-with-python-how-and-why.html
-    # this could be made more efficient using numpy
-    histogram = img.histogram()
-    histogram_length = sum(histogram)
-    samples_probability = [float(h) / histogram_length for h in histogram]
-    return -sum([p * math.log(p, 2) for p in samples_probability if p != 0])
-
-def get_num_unique_frames(capture, threshold=0):
-    framediff_sums = get_framediff_sums(capture)
+    return float(get_histogram_entropies(img.histogram()))
+
+def get_num_unique_frames(capture, threshold=0, downsample=1):
+    framediff_sums = get_framediff_sums(capture, downsample=downsample)
+    # threshold is in pixels of the full size frames
+    scaled_threshold = float(threshold) / downsample ** 2
     num_uniques = len(
-        [framediff for framediff in framediff_sums if framediff > threshold])
+        [framediff for framediff in framediff_sums
+         if framediff > scaled_threshold])
     if threshold > 0:
         # first frame not included if threshold is greater than 0
         num_uniques += 1
 
     return num_uniques
 
-def get_fps(capture, threshold=0):
-    return get_num_unique_frames(capture, threshold=threshold) / capture.length
+def get_fps(capture, threshold=0, downsample=1):
+    return get_num_unique_frames(capture, threshold=threshold,
+                                 downsample=downsample) / capture.length
@@ -0,0 +1,25 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Per-frame analysis results are cached for each frame on its own, keyed by
+# the frame's contents (see Capture.get_frame_key) rather than by capture.
+# So when a capture is converted again with different start and end frames,
+# or has frames added to it, only the frames which haven't been analyzed
+# before need to be.
+
+def get_cached_frame_results(capture, name, start, params=None, version=1,
+                             with_previous=False):
+    '''The cached results of an analysis for the frames in
+       [start, num_frames] of a capture. Returns the frame keys, the
+       results (None where there aren't any) and the frames which are
+       missing results.'''
+    framekeys = capture.get_frame_keys(start, capture.num_frames + 1,
+                                       with_previous)
+    cached = capture.cache.get_frames(name, framekeys, params, version)
+    results = [cached.get(framekey) for framekey in framekeys]
+    missing = [start + i for (i, framekey) in enumerate(framekeys)
+               if framekey not in cached]
+
+    return (framekeys, results, missing)
+
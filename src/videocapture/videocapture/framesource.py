@@ -0,0 +1,137 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Ways of reading the frames of a capture before it has been converted:
+# either straight out of the raw stream written by the decklink capture
+# program, or from the directory of images written by the pointgrey one.
+# Frame sources are sequences of frames, and each frame is small enough to
+# hand off to another process to be read there.
+
+from PIL import Image
+import numpy
+import os
+import re
+
+
+def _natural_key(str):
+    """See http://www.codinghorror.com/blog/archives/001018.html"""
+    return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', str)]
+
+
+def uyvy_to_rgb(data, width, height):
+    '''Convert a frame of 8-bit 4:2:2 YUV (UYVY byte order, as written by
+       the decklink cards) to an RGB array, using the standard integer BT.601
+       coefficients (which is also what avconv uses by default)'''
+    data = numpy.asarray(data, dtype=numpy.int32).reshape(
+        height, width / 2, 4)
+    # each four bytes hold two pixels, which share their chroma values
+    luma = numpy.empty((height, width), dtype=numpy.int32)
+    luma[:, 0::2] = data[:, :, 1]
+    luma[:, 1::2] = data[:, :, 3]
+    luma = 298 * (luma - 16) + 128
+    u = numpy.repeat(data[:, :, 0] - 128, 2, axis=1)
+    v = numpy.repeat(data[:, :, 2] - 128, 2, axis=1)
+
+    rgb = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    rgb[:, :, 0] = numpy.clip((luma + 409 * v) >> 8, 0, 255)
+    rgb[:, :, 1] = numpy.clip((luma - 100 * u - 208 * v) >> 8, 0, 255)
+    rgb[:, :, 2] = numpy.clip((luma + 516 * u) >> 8, 0, 255)
+
+    return rgb
+
+
+def uyvy_rows_to_rgb(rows, columns):
+    '''Convert the given columns ((x1, x2)) of some rows of a UYVY frame
+       (an array of rows x bytes per row) to an RGB array'''
+    (x1, x2) = columns
+    width = rows.shape[1] / 2
+    # pixels are stored in pairs which share their chroma values, so
+    # convert from the pair boundaries on either side of the area
+    (pairx1, pairx2) = (x1 - x1 % 2, min(width, x2 + x2 % 2))
+    rgb = uyvy_to_rgb(rows[:, pairx1 * 2:pairx2 * 2], pairx2 - pairx1,
+                      rows.shape[0])
+    return rgb[:, x1 - pairx1:x2 - pairx1]
+
+
+class RawFrame(object):
+    '''A single frame in a raw decklink capture file'''
+
+    def __init__(self, filename, offset, width, height):
+        self.filename = filename
+        self.offset = offset
+        self.width = width
+        self.height = height
+
+    def get_array(self, area=None):
+        '''Get the frame as an RGB array. If area ([x1, y1, x2, y2]) is
+           given, only that part of the frame is read and converted'''
+        (x1, y1, x2, y2) = area or (0, 0, self.width, self.height)
+        rowbytes = self.width * 2
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset + y1 * rowbytes)
+            data = numpy.fromfile(f, dtype=numpy.uint8,
+                                  count=(y2 - y1) * rowbytes)
+        return uyvy_rows_to_rgb(data.reshape(y2 - y1, rowbytes),
+                                (x1, x2))
+
+    def get_image(self):
+        return Image.fromarray(self.get_array())
+
+
+class RawFrameSource(object):
+    '''The frames in a raw (8-bit 4:2:2 YUV) decklink capture file'''
+
+    def __init__(self, filename, dimensions):
+        self.filename = filename
+        (self.width, self.height) = self.dimensions = tuple(dimensions)
+        self.frame_size = self.width * self.height * 2
+
+    def __len__(self):
+        # only count frames which have been completely written
+        return os.path.getsize(self.filename) / self.frame_size
+
+    def __getitem__(self, framenum):
+        if framenum < 0:
+            framenum += len(self)
+        if framenum < 0 or framenum >= len(self):
+            raise IndexError("Frame %s not in capture" % framenum)
+        return RawFrame(self.filename, framenum * self.frame_size,
+                        self.width, self.height)
+
+
+class ImageFileFrame(object):
+    '''A single frame in an image file'''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def get_array(self, area=None):
+        im = self.get_image()
+        if area:
+            im = im.crop(area)
+        return numpy.array(im.convert("RGB"))
+
+    def get_image(self):
+        return Image.open(self.filename)
+
+
+class ImageDirectoryFrameSource(object):
+    '''The frames in a directory of numbered images'''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.filenames = [os.path.join(dirname, filename) for filename in
+                          sorted(os.listdir(dirname), key=_natural_key)]
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, framenum):
+        return ImageFileFrame(self.filenames[framenum])
+
+    @property
+    def dimensions(self):
+        if not self.filenames:
+            return (0, 0)
+        return self[0].get_image().size
@@ -0,0 +1,201 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Analysis of a capture's frames while it is still being captured. The
+# results are stored in the converted capture's cache, so they don't need
+# to be worked out again after the capture has finished.
+
+from PIL import Image
+from capture import Capture
+from entropy import _get_entropy, _get_entropy_params, ENTROPY_VERSION
+from framediff import _get_framediff_histogram, _get_framediff_params, \
+    _get_framediff_histogram_params, get_framediff_counts, \
+    FRAMEDIFF_VERSION, PIXEL_DIFF_THRESHOLD
+from square import get_biggest_square
+from stableframe import STABLE_FRAME_THRESHOLD
+import mozlog
+import multiprocessing
+import numpy
+import traceback
+
+
+class LiveAnalysisProcess(multiprocessing.Process):
+    '''Computes frame difference sums and entropies for the frames of a
+       capture as they are captured. The numbers of new frames are sent
+       over frame_queue (None once the capture has finished), and the
+       results are put on results_queue once all the frames have been
+       analyzed.
+
+       Frames are analyzed in the same way as they would be after the
+       capture is converted: cropped to the capture area (either the one
+       given, or found from the start of capture signal, in the same way
+       as CaptureController.convert_capture) and converted to grayscale.
+
+       If stable_framenum (a shared integer) is given, it gets set to the
+       frame from which the capture is stable, once no frame has differed
+       from the one before it by more than stable_threshold pixels for
+       stable_frames frames, after at least one frame has (see the
+       framediff method of get_stable_frame).
+
+       Something always gets put on results_queue, even if the analysis
+       fails (None, in that case). The process is a daemon, so it never
+       holds up the main process exiting if nobody collects its results.'''
+
+    logger = mozlog.getLogger('Live Analysis Process')
+
+    def __init__(self, frames, frame_queue, results_queue,
+                 capture_area=None, find_start_signal=True,
+                 ignored_areas=None, edge_detections=(None,),
+                 stable_framenum=None, stable_frames=None,
+                 stable_threshold=STABLE_FRAME_THRESHOLD):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+        self.frames = frames
+        self.frame_queue = frame_queue
+        self.results_queue = results_queue
+        self.capture_area = capture_area
+        self.find_start_signal = find_start_signal
+        self.ignored_areas = ignored_areas or []
+        self.edge_detections = edge_detections
+        self.stable_framenum = stable_framenum
+        self.stable_frames = stable_frames
+        self.stable_threshold = stable_threshold
+
+    def run(self):
+        results = None
+        try:
+            results = self._analyze_capture()
+        except Exception:
+            self.logger.error("Live analysis failed:\n%s" %
+                              traceback.format_exc())
+        finally:
+            self.results_queue.put(results)
+
+    def _analyze_capture(self):
+        results = {'captureArea': None,
+                   'firstFrame': None,
+                   'diffsums': [],
+                   'diffhistograms': [],
+                   'entropies': dict((edge_detection, []) for edge_detection
+                                     in self.edge_detections)}
+        if not self.find_start_signal:
+            results['captureArea'] = self.capture_area
+            results['firstFrame'] = 0
+
+        framenum = 0
+        last_change = None
+        squares = []
+        prevframe = None
+        finished = False
+        while not finished:
+            try:
+                finished = self.frame_queue.get() is None
+            except KeyboardInterrupt:
+                finished = True
+
+            # catch up with every frame that has been completely written
+            num_frames = len(self.frames)
+            for framenum in range(framenum, num_frames):
+                if results['firstFrame'] is None:
+                    imgarray = numpy.array(self.frames[framenum].get_array(),
+                                           dtype=numpy.int16)
+                    squares.append(get_biggest_square((0, 255, 0), imgarray))
+                    if framenum > 1 and not squares[-1] and squares[-2]:
+                        results['captureArea'] = squares[-2]
+                        results['firstFrame'] = framenum - 1
+                        self.logger.info("Found start capture signal at "
+                                         "frame %s. Area: %s" %
+                                         (framenum, squares[-2]))
+                        prevframe = self._get_frame(framenum - 1,
+                                                    results['captureArea'])
+                        self._analyze_frame(prevframe, None, results)
+                    else:
+                        continue
+
+                frame = self._get_frame(framenum, results['captureArea'])
+                self._analyze_frame(frame, prevframe, results)
+                prevframe = frame
+
+                if results['diffsums'][-1] > self.stable_threshold:
+                    last_change = framenum
+                elif self.stable_framenum is not None and \
+                        self.stable_framenum.value < 0 and \
+                        last_change is not None and \
+                        framenum - last_change >= self.stable_frames:
+                    self.logger.info("Capture stable from frame %s" %
+                                     (last_change + 1))
+                    self.stable_framenum.value = last_change + 1
+            framenum = num_frames
+
+        return results
+
+    def _get_frame(self, framenum, capture_area):
+        return numpy.array(Image.fromarray(
+            self.frames[framenum].get_array(capture_area)).convert("L"))
+
+    def _analyze_frame(self, frame, prevframe, results):
+        histogram = numpy.zeros(256, dtype=numpy.uint32)
+        if prevframe is not None:
+            histogram = _get_framediff_histogram(prevframe.astype('float'),
+                                                 frame.astype('float'),
+                                                 self.ignored_areas)
+        results['diffhistograms'].append(histogram)
+        results['diffsums'].append(get_framediff_counts(
+            [histogram], PIXEL_DIFF_THRESHOLD)[0])
+        for edge_detection in self.edge_detections:
+            results['entropies'][edge_detection].append(
+                _get_entropy(frame, edge_detection))
+
+
+def store_live_analysis(results, capture_filename, capture_area,
+                        ignored_areas, source_framenums):
+    '''Store the results of a live analysis in the cache for a converted
+       capture, whose frames came from source_framenums of the original
+       capture. Returns whether the results could be used'''
+    if results['firstFrame'] is None or \
+            list(results['captureArea'] or []) != list(capture_area or []):
+        return False
+
+    # a capture has results for all but its last frame (see Capture)
+    source_framenums = source_framenums[:-1]
+    first = results['firstFrame']
+    last = first + len(results['diffsums'])
+    if not source_framenums or min(source_framenums) < first or \
+            max(source_framenums) >= last:
+        return False
+
+    histograms = numpy.zeros((len(source_framenums), 256),
+                             dtype=numpy.uint32)
+    for (i, (prevframenum, framenum)) in enumerate(zip(source_framenums,
+                                                       source_framenums[1:])):
+        if prevframenum != framenum - 1 or prevframenum < first:
+            return False
+        histograms[i + 1] = results['diffhistograms'][framenum - first]
+
+    # results are cached for each frame of the converted capture (see
+    # frameresults)
+    capture = Capture(capture_filename)
+    end = len(source_framenums)
+    diff_framekeys = capture.get_frame_keys(0, end, with_previous=True)
+    framekeys = capture.get_frame_keys(0, end)
+    capture.cache.set_frames('diffhistograms',
+                             dict(zip(diff_framekeys, histograms)),
+                             _get_framediff_histogram_params(
+                                 ignored_areas or []),
+                             FRAMEDIFF_VERSION)
+    capture.cache.set_frames('diffsums',
+                             dict(zip(diff_framekeys, get_framediff_counts(
+                                 histograms, PIXEL_DIFF_THRESHOLD))),
+                             _get_framediff_params(ignored_areas or [],
+                                                   PIXEL_DIFF_THRESHOLD),
+                             FRAMEDIFF_VERSION)
+    for (edge_detection, entropies) in results['entropies'].iteritems():
+        capture.cache.set_frames('frame_entropies',
+                                 dict(zip(framekeys,
+                                          [entropies[framenum - first] for
+                                           framenum in source_framenums])),
+                                 _get_entropy_params(edge_detection),
+                                 ENTROPY_VERSION)
+
+    return True
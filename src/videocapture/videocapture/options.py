@@ -30,6 +30,16 @@ class OptionParser(optparse.OptionParser):
                         default=None, dest="camera_settings_file",
                         help="Custom camera settings json to use with "
                         "pointgrey cameras")
+        self.add_option("--live-analysis", action="store_true",
+                        default=False, dest="live_analysis",
+                        help="Analyze frames while capturing, so that frame "
+                        "differences and entropies are ready as soon as the "
+                        "capture has been converted (decklink only)")
+        self.add_option("--frame-buffer-size", action="store", type="int",
+                        default=None, dest="frame_buffer_size",
+                        help="Keep this many of the most recent frames of a "
+                        "capture in shared memory, for live analysis and "
+                        "previews (decklink only)")
 
         if self.capture_area_option:
             self.add_option("--capture-area", action="store",
@@ -0,0 +1,83 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import concurrent.futures
+import multiprocessing
+import os
+
+# how many ranges of frames to hand out to each worker: more than one so
+# that a worker which finishes early can pick up some of the slack
+RANGES_PER_WORKER = 4
+
+
+def get_default_max_workers():
+    '''The number of worker processes to analyze captures with, unless
+       told otherwise: ANALYSIS_WORKERS in the environment if set (e.g. to
+       limit how much of a shared machine we use), otherwise one per CPU'''
+    return int(os.environ.get('ANALYSIS_WORKERS', 0)) or \
+        multiprocessing.cpu_count()
+
+
+def get_frame_ranges(start, end, num_ranges):
+    '''Split the frames in [start, end) into at most num_ranges contiguous
+       (start, end) ranges of (roughly) equal size'''
+    num_frames = end - start
+    if num_frames <= 0:
+        return []
+
+    num_ranges = max(1, min(num_ranges, num_frames))
+    ranges = []
+    for i in range(num_ranges):
+        ranges.append((start + (num_frames * i) / num_ranges,
+                       start + (num_frames * (i + 1)) / num_ranges))
+
+    return ranges
+
+
+def get_frame_runs(framenums):
+    '''Split a sorted list of frame numbers into (start, end) ranges of
+       consecutive frames'''
+    runs = []
+    for framenum in framenums:
+        if runs and runs[-1][1] == framenum:
+            runs[-1][1] = framenum + 1
+        else:
+            runs.append([framenum, framenum + 1])
+
+    return [tuple(run) for run in runs]
+
+
+def map_frame_range_list(func, capture, ranges, args=(), max_workers=None):
+    '''Run func over several (start, end) ranges of the frames of a
+       capture in a pool of worker processes, sharing out the work between
+       the workers in proportion to the size of each range. Each call to
+       func is passed a tuple of (capture, range_start, range_end) + args,
+       and should return a list with one result per frame in its range.
+       Returns a list of the results for each range, in order.'''
+    if not max_workers:
+        max_workers = get_default_max_workers()
+
+    total_frames = sum(end - start for (start, end) in ranges)
+    subranges = []
+    for (i, (start, end)) in enumerate(ranges):
+        num_ranges = max(1, max_workers * RANGES_PER_WORKER *
+                         (end - start) / max(1, total_frames))
+        subranges.extend((i, subrange_start, subrange_end) for
+                         (subrange_start, subrange_end) in
+                         get_frame_ranges(start, end, num_ranges))
+
+    results = [[] for range in ranges]
+    if not subranges:
+        return results
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers) as executor:
+        for ((i, subrange_start, subrange_end), range_results) in zip(
+                subranges, executor.map(
+                    func, [(capture, subrange_start, subrange_end) +
+                           tuple(args) for (i, subrange_start, subrange_end)
+                           in subranges])):
+            results[i].extend(range_results)
+
+    return results
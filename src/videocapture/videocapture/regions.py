@@ -0,0 +1,66 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Named regions of a capture's frames, which metrics can be worked out for
+# separately (e.g. the page content apart from the url bar). Regions are
+# defined in a capture's metadata, like so:
+#
+#   "regions": {"urlbar": {"include": [[0, 0, 1280, 96]]},
+#               "content": {"exclude": [[0, 0, 1280, 96]]}}
+#
+# Rectangles are [x1, y1, x2, y2], in pixels of the capture's frames. A
+# region covers everything in its include rectangles (or the whole frame
+# if it has none), less anything in its exclude rectangles.
+
+from capture import CaptureException
+from framediff import _downsample_areas
+import numpy
+
+
+class Region(object):
+    '''A named region of a capture's frames'''
+
+    def __init__(self, name, include=None, exclude=None):
+        self.name = name
+        self.include = include or []
+        self.exclude = exclude or []
+        self._masks = {}
+
+    def get_params(self):
+        '''The region's definition, for caching results worked out for it'''
+        return {'include': self.include, 'exclude': self.exclude}
+
+    def get_mask(self, shape, downsample=1):
+        '''A boolean array of the pixels in the region, for frames of the
+           given shape (downsampled by a factor, see Capture.get_frame)'''
+        key = (tuple(shape[:2]), downsample)
+        if key not in self._masks:
+            mask = numpy.ones(shape[:2], dtype=numpy.bool)
+            if self.include:
+                mask[:] = False
+                for (x1, y1, x2, y2) in _downsample_areas(self.include,
+                                                          downsample):
+                    mask[max(0, y1):max(0, y2), max(0, x1):max(0, x2)] = True
+            for (x1, y1, x2, y2) in _downsample_areas(self.exclude,
+                                                      downsample):
+                mask[max(0, y1):max(0, y2), max(0, x1):max(0, x2)] = False
+            self._masks[key] = mask
+
+        return self._masks[key]
+
+
+def get_regions(capture):
+    '''The regions defined for a capture, by name'''
+    return dict((name, Region(name, definition.get('include'),
+                              definition.get('exclude')))
+                for (name, definition) in
+                (capture.metadata.get('regions') or {}).iteritems())
+
+
+def get_region(capture, name):
+    regions = get_regions(capture)
+    if name not in regions:
+        raise CaptureException("No region '%s' defined for capture" % name)
+
+    return regions[name]
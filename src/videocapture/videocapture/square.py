@@ -10,6 +10,39 @@ X_TOLERANCE_MIN = 192 + 1  # ignore frame counter on left for fennec
 X_TOLERANCE_MAX = 1
 
 
+def _get_scanlines(thresharray, handle_multiple_scanlines):
+    ''' Get the scanline (as a (y, x1, x2) tuple) for each row of a
+        boolean array that has one '''
+    if not handle_multiple_scanlines:
+        # just the first and last matching pixel in each row
+        rows = numpy.nonzero(thresharray.any(axis=1))[0]
+        width = thresharray.shape[1]
+        firsts = thresharray[rows].argmax(axis=1)
+        lasts = width - 1 - thresharray[rows, ::-1].argmax(axis=1)
+        return zip(rows.tolist(), firsts.tolist(), lasts.tolist())
+
+    # break the matching pixels in each row into runs, allowing for gaps of
+    # up to two pixels, and pick out the longest run (the leftmost, if
+    # there's a tie) in each row. runs of a single pixel don't count.
+    (ys, xs) = numpy.nonzero(thresharray)
+    if not len(ys):
+        return []
+    breaks = numpy.nonzero((numpy.diff(ys) != 0) | (numpy.diff(xs) > 2))[0]
+    starts = numpy.concatenate(([0], breaks + 1))
+    ends = numpy.concatenate((breaks, [len(ys) - 1]))
+    (rows, x1s, x2s) = (ys[starts], xs[starts], xs[ends])
+    lengths = x2s - x1s
+    valid = lengths > 0
+    (rows, x1s, x2s, lengths) = (rows[valid], x1s[valid], x2s[valid],
+                                 lengths[valid])
+    order = numpy.lexsort((x1s, -lengths, rows))
+    (rows, x1s, x2s) = (rows[order], x1s[order], x2s[order])
+    firsts = numpy.concatenate(([True], rows[1:] != rows[:-1])) \
+        if len(rows) else []
+    return zip(rows[firsts].tolist(), x1s[firsts].tolist(),
+               x2s[firsts].tolist())
+
+
 def get_squares(rgb, imgarray, x_tolerance_min=X_TOLERANCE_MIN,
                 x_tolerance_max=X_TOLERANCE_MAX,
                 handle_multiple_scanlines=False):
@@ -23,47 +56,30 @@ def get_squares(rgb, imgarray, x_tolerance_min=X_TOLERANCE_MIN,
 
     thresharray = numpy.abs(imgarray - mask)
     thresharray = ((thresharray[:, :, 0] + thresharray[:, :, 1] + thresharray[:, :, 2]) < threshold)
-    for y, row in enumerate(thresharray):
-        scanline = None
-        where = numpy.nonzero(row)[0]
-        if len(where):
-            if handle_multiple_scanlines:
-                scanlines = []
-                current_scanline = [where[0], where[0]]
-                last = where[0]
-                for pos in where[1:]:
-                    if (pos - last) > 2:
-                        if (current_scanline[1] - current_scanline[0]) > 0:
-                            scanlines.append(current_scanline)
-                        current_scanline = [pos, pos]
-                    else:
-                        current_scanline[1] = pos
-                    last = pos
-                if current_scanline not in scanlines and (
-                        current_scanline[1] - current_scanline[0]) > 0:
-                    scanlines.append(current_scanline)
-                if len(scanlines):
-                    scanline = max(scanlines, key=lambda s: s[1] - s[0])
-            else:
-                scanline = [where[0], where[-1]]
-
-        if scanline:
-            found_existing = False
-            for square in squares:
-
-                if square[3] == (y - 1) and \
-                        abs(square[0] - scanline[0]) < x_tolerance_min and \
-                        abs(square[2] - scanline[1]) < x_tolerance_max:
-                    square[3] = y
-                    found_existing = True
-                    # expand the square if the scanline is bigger
-                    if square[0] > scanline[0]:
-                        square[0] = scanline[0]
-                    if square[2] < scanline[1]:
-                        square[2] = scanline[1]
-
-            if not found_existing:
-                squares.append([int(scanline[0]), y, int(scanline[1]), y])
+
+    # only squares which reached the previous row can be extended by a
+    # scanline, so just keep track of those as we go
+    active_squares = []
+    for (y, x1, x2) in _get_scanlines(thresharray,
+                                      handle_multiple_scanlines):
+        extended_squares = []
+        for square in active_squares:
+            if square[3] == (y - 1) and \
+                    abs(square[0] - x1) < x_tolerance_min and \
+                    abs(square[2] - x2) < x_tolerance_max:
+                square[3] = y
+                # expand the square if the scanline is bigger
+                if square[0] > x1:
+                    square[0] = x1
+                if square[2] < x2:
+                    square[2] = x2
+                extended_squares.append(square)
+
+        if not extended_squares:
+            square = [x1, y, x2, y]
+            squares.append(square)
+            extended_squares.append(square)
+        active_squares = extended_squares
 
     return squares
 
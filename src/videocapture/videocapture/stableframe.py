@@ -1,31 +1,115 @@
 from framediff import get_framediff_sums
 from entropy import get_frame_entropies
+import numpy
 import scipy.stats
 
+# number of pixels which need to change between frames for the later one
+# not to be considered stable (framediff method)
+STABLE_FRAME_THRESHOLD = 4096
+
+def _get_window_stats(sums, squares, changes, starts, window_size):
+    """ Means and variances of the windows of entropies starting at each of
+        starts, worked out from cumulative sums of the values and squares.
+        Windows which don't change at all are given a variance of exactly
+        zero (rounding errors would otherwise leave a tiny one). """
+    windowsums = sums[starts + window_size] - sums[starts]
+    means = windowsums / window_size
+    variances = numpy.maximum(squares[starts + window_size] - squares[starts] -
+                              windowsums * means, 0) / (window_size - 1)
+    constant = changes[starts + window_size] == changes[starts + 1]
+    variances[constant] = 0
+
+    return (means, variances, constant)
+
+def _get_entropy_pvalues(entropies, window_size=10):
+    """ P-value of welch's t-test (which does not assume equal variance
+        between populations) between the window_size entropies before each
+        frame and the window_size from that frame on, for all frames at
+        once. NaN where there aren't enough frames on either side. Gives the
+        same results as scipy.stats.ttest_ind on each pair of windows (to
+        within rounding errors). """
+    entropies = numpy.asarray(entropies, dtype=numpy.float)
+    pvalues = numpy.empty(len(entropies))
+    pvalues.fill(numpy.nan)
+    if len(entropies) < 2 * window_size:
+        return pvalues
+
+    # centre the values to keep down rounding errors in the variances
+    values = entropies - entropies.mean()
+    sums = numpy.concatenate(([0], numpy.cumsum(values)))
+    squares = numpy.concatenate(([0], numpy.cumsum(values ** 2)))
+    # changes[k] is the number of frames in [1, k) which differ from the one
+    # before them
+    changes = numpy.concatenate(([0, 0], numpy.cumsum(
+        entropies[1:] != entropies[:-1])))
+
+    indices = numpy.arange(window_size, len(entropies) - window_size + 1)
+    (prevmeans, prevvariances, prevconstant) = _get_window_stats(
+        sums, squares, changes, indices - window_size, window_size)
+    (nextmeans, nextvariances, nextconstant) = _get_window_stats(
+        sums, squares, changes, indices, window_size)
+    differences = nextmeans - prevmeans
+    # exact difference between windows which don't change at all
+    constant = prevconstant & nextconstant
+    differences[constant] = entropies[indices[constant]] - \
+        entropies[indices[constant] - 1]
+
+    # see scipy.stats.ttest_ind
+    prevvariances /= window_size
+    nextvariances /= window_size
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        df = (prevvariances + nextvariances) ** 2 / (
+            (prevvariances ** 2 + nextvariances ** 2) / (window_size - 1))
+        df[numpy.isnan(df)] = 1
+        t = differences / numpy.sqrt(prevvariances + nextvariances)
+    # the windows are the same if neither changes and they have the same
+    # value (scipy gives either NaN or 1 here, depending on rounding errors)
+    t[constant & (differences == 0)] = 0
+    pvalues[indices] = scipy.stats.t.sf(numpy.abs(t), df) * 2
+
+    return pvalues
+
 def _get_stable_frame_from_entropies(entropies, window_size=10, pvalue_threshold=0.000031):
-    for i in range(len(entropies)-window_size, window_size, -1):
-        previousrange = entropies[i-window_size:i]
-        nextrange = entropies[i:i+window_size]
-        # use welch's ttest, which does not assume equal variance between
-        # populations
-        pvalue = scipy.stats.ttest_ind(nextrange, previousrange, equal_var=False)[1]
-        if pvalue < pvalue_threshold:
-            return i
+    """ The last frame at which the entropies change significantly (see
+        _get_entropy_pvalues), or 0 if there isn't one """
+    pvalues = _get_entropy_pvalues(entropies, window_size)
+    with numpy.errstate(invalid='ignore'):
+        frames = numpy.nonzero(pvalues < pvalue_threshold)[0]
+    frames = frames[frames > window_size]
+    if len(frames):
+        return int(frames[-1])
     return 0
 
+def get_stable_frame_pvalues(capture, edge_detection=None, window_size=10):
+    """ P-values used to find the stable frame of a capture by the entropy
+        method, one per frame (None where there isn't one): handy for
+        plotting and for tuning pvalue_threshold """
+    return [None if numpy.isnan(pvalue) else float(pvalue) for pvalue in
+            _get_entropy_pvalues(get_frame_entropies(
+                capture, edge_detection=edge_detection), window_size)]
+
 def get_stable_frame(capture, method='framediff', edge_detection=None,
-                     threshold=4096):
+                     threshold=STABLE_FRAME_THRESHOLD, downsample=1):
+    """ If downsample is given, frames are shrunk by that factor before
+        being compared (see Capture.get_frame). threshold is still in
+        pixels of the full size frames. """
     if method == 'framediff':
-        framediff_sums = get_framediff_sums(capture)
+        framediff_sums = get_framediff_sums(capture, downsample=downsample)
+        # each difference counted is a block of downsample x downsample
+        # pixels
+        threshold = float(threshold) / downsample ** 2
         for i in range(len(framediff_sums) - 1, 0, -1):
             if framediff_sums[i] > threshold:
                 return i + 1
         return len(framediff_sums) - 1
     elif method == 'entropy':
         return _get_stable_frame_from_entropies(
-            get_frame_entropies(capture, edge_detection=None))
+            get_frame_entropies(capture, edge_detection=None,
+                                downsample=downsample))
 
-def get_stable_frame_time(capture, method='framediff', threshold=4096,
-                          edge_detection=None):
+def get_stable_frame_time(capture, method='framediff',
+                          threshold=STABLE_FRAME_THRESHOLD,
+                          edge_detection=None, downsample=1):
     return get_stable_frame(capture, method=method, threshold=threshold,
-                            edge_detection=edge_detection) / float(capture.fps)
+                            edge_detection=edge_detection,
+                            downsample=downsample) / float(capture.fps)
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Encoding the movies of captures, by piping their frames into an encoder
+# (avconv or vpxenc) as raw video.
+
+import multiprocessing
+import numpy
+import os
+import subprocess
+import tempfile
+
+DEFAULT_WEBM_BIT_RATE = 1024
+
+
+def _get_yuv420_data(rgb):
+    '''Convert an RGB array to planar 4:2:0 YUV (the layout of a frame in a
+       y4m stream), using the standard integer BT.601 coefficients'''
+    (height, width) = rgb.shape[:2]
+    # pad out odd dimensions, so each chroma sample covers 2x2 pixels
+    rgb = numpy.pad(rgb, ((0, height % 2), (0, width % 2), (0, 0)),
+                    'edge').astype(numpy.int32)
+    (r, g, b) = (rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2])
+    y = ((66 * r + 129 * g + 25 * b + 128) >> 8) + 16
+    u = ((-38 * r - 74 * g + 112 * b + 128) >> 8) + 128
+    v = ((112 * r - 94 * g - 18 * b + 128) >> 8) + 128
+
+    def _subsample(plane):
+        return (plane[0::2, 0::2] + plane[0::2, 1::2] + plane[1::2, 0::2] +
+                plane[1::2, 1::2] + 2) >> 2
+
+    return ''.join(plane.astype(numpy.uint8).tobytes() for plane in
+                   (y[:height, :width], _subsample(u), _subsample(v)))
+
+
+def get_video_frame_data(im, video_format):
+    '''Get the data to write to an encoder for an RGB image, in the format
+       returned by start_video_encoder'''
+    if video_format == 'yuv420p':
+        return 'FRAME\n' + _get_yuv420_data(numpy.array(im))
+    return im.tobytes()
+
+
+class SpooledVideoEncoder(object):
+    '''Stands in for an encoder process which has to read its input from a
+       file rather than a pipe (vpxenc, to make two passes over it): the
+       frames written to stdin are spooled to a temporary file next to the
+       movie, and the encoder is only run over it once they all have been,
+       on wait()'''
+
+    def __init__(self, args, moviefilename):
+        self.args = args
+        self.stdin = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(moviefilename)),
+            suffix='.y4m', delete=False)
+        self.returncode = None
+
+    def wait(self):
+        if self.returncode is None:
+            self.stdin.close()
+            try:
+                self.returncode = subprocess.call(
+                    self.args + (self.stdin.name,), close_fds=True)
+            finally:
+                os.remove(self.stdin.name)
+
+        return self.returncode
+
+
+def start_video_encoder(moviefilename, dimensions, fps, use_vpxenc=False):
+    '''Start encoding a movie from raw frames written to the encoder's
+       stdin. Returns the encoder process, along with the format the frames
+       need to be in ('rgb24' or 'yuv420p').'''
+    (width, height) = dimensions
+    # png2yuv is broken on Ubuntu 12.04 and earlier, so we can't use
+    # vpxenc there by default
+    if use_vpxenc:
+        encoder = SpooledVideoEncoder(
+            ('vpxenc', '--good', '--cpu-used=0', '--end-usage=vbr',
+             '--passes=2',
+             '--threads=%s' % (multiprocessing.cpu_count() - 1),
+             '--target-bitrate=%s' % DEFAULT_WEBM_BIT_RATE,
+             '-o', moviefilename), moviefilename)
+        # y4m frame rates have to be a ratio of whole numbers
+        encoder.stdin.write('YUV4MPEG2 W%s H%s F%d:1 Ip A1:1 C420jpeg\n' %
+                            (width, height, int(round(fps))))
+        return (encoder, 'yuv420p')
+
+    encoder = subprocess.Popen(
+        ('avconv', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+         '-s', '%sx%s' % (width, height), '-r', str(fps), '-i', '-',
+         moviefilename), stdin=subprocess.PIPE, close_fds=True)
+    return (encoder, 'rgb24')
+
+
+def encode_video(images, moviefilename, dimensions, fps, use_vpxenc=False):
+    '''Encode a movie from a sequence of RGB images. Returns the encoder's
+       exit status.'''
+    (encoder, video_format) = start_video_encoder(moviefilename, dimensions,
+                                                  fps, use_vpxenc)
+    for im in images:
+        encoder.stdin.write(get_video_frame_data(im, video_format))
+    encoder.stdin.close()
+
+    return encoder.wait()
@@ -0,0 +1,99 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from capture import Capture, CaptureException
+import Queue
+import mozlog
+import shutil
+import threading
+
+
+class VideoEncodeJob(object):
+    '''A movie queued up to be encoded (see VideoEncodeQueue.put). If the
+       encode (or copying the movie to output_filename) fails, error is set
+       to why.'''
+
+    def __init__(self, filename, output_filename=None):
+        self.filename = filename
+        self.output_filename = output_filename
+        self.error = None
+        self.event = threading.Event()
+
+    def wait(self):
+        '''Wait for the movie to be encoded, raising a CaptureException if
+           that failed'''
+        self.event.wait()
+        if self.error:
+            raise CaptureException(self.error)
+
+
+class VideoEncodeQueue(object):
+    '''Encodes the movies of captures written without one (see
+       Capture.get_video) in a background thread, one capture at a time'''
+
+    logger = mozlog.getLogger('Video Encode Queue')
+
+    def __init__(self, use_vpxenc=False):
+        self.use_vpxenc = use_vpxenc
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        # capture filename -> job for the encode of its movie in progress
+        self.pending = {}
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, filename, output_filename=None):
+        '''Queue up encoding the movie of a capture (if it doesn't have one
+           already), copying it to output_filename once done if given.
+           Returns the job (see VideoEncodeJob), which says whether this
+           worked once it is done.'''
+        job = VideoEncodeJob(filename, output_filename)
+        with self.lock:
+            self.pending.setdefault(filename, job)
+        self.queue.put(job)
+        return job
+
+    def get_video(self, filename):
+        '''Get the movie of a capture, waiting for it to be encoded if need
+           be. Only one encode of any capture is queued at a time.'''
+        capture = Capture(filename)
+        if not capture.has_video:
+            with self.lock:
+                job = self.pending.get(filename)
+            if not job:
+                job = self.put(filename)
+            job.wait()
+            capture = Capture(filename)
+
+        return capture.get_video()
+
+    def join(self):
+        '''Wait for everything queued to be done (whether it worked or not:
+           see the jobs returned by put)'''
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                capture = Capture(job.filename)
+                if not capture.has_video:
+                    self.logger.info("Encoding movie for '%s'" % job.filename)
+                    capture.encode_video(self.use_vpxenc)
+                if job.output_filename:
+                    with open(job.output_filename, 'wb') as f:
+                        shutil.copyfileobj(capture.get_video(), f)
+            except Exception, e:
+                # the thread carries on with the next job: whoever queued
+                # this one finds out from the job itself
+                job.error = "Couldn't encode movie for '%s': %s" % (
+                    job.filename, e)
+                self.logger.error(job.error)
+            finally:
+                with self.lock:
+                    if self.pending.get(job.filename) is job:
+                        del self.pending[job.filename]
+                job.event.set()
+                self.queue.task_done()